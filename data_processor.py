@@ -4,17 +4,59 @@ Scene Graph Dataset Processor
 将原始场景数据转换为HuggingFace数据集格式
 """
 
+import argparse
 import json
 import os
 import glob
+import hashlib
+import io
+import multiprocessing
+import traceback
 from PIL import Image, ImageDraw, ImageFont
-from datasets import Dataset, DatasetDict
+from datasets import Dataset, DatasetDict, Features, Sequence, Value, load_dataset
+from datasets import Image as ImageFeature
 import random
 from tqdm import tqdm
-from collections import defaultdict
+from collections import defaultdict, deque
+from functools import partial
+from itertools import islice
+
+# 数据集的schema, 图像以编码后的bytes存储
+SHARD_FEATURES = Features({
+    "images": Sequence(ImageFeature()),
+    "problem": Value("string"),
+    "answer": Value("string")
+})
+PROGRESS_FILE = "progress.json"
+SCENE_INDEX_FILE = "scene_index.json"
+
+# 可选的resize滤波器
+RESAMPLE_FILTERS = {
+    "nearest": Image.Resampling.NEAREST,
+    "box": Image.Resampling.BOX,
+    "bilinear": Image.Resampling.BILINEAR,
+    "hamming": Image.Resampling.HAMMING,
+    "bicubic": Image.Resampling.BICUBIC,
+    "lanczos": Image.Resampling.LANCZOS
+}
 
 class SceneGraphProcessor:
-    def __init__(self):
+    def __init__(self, resample="lanczos", use_draft=True, image_format="PNG", jpeg_quality=95):
+        """
+        resample: 拼接时缩放各视角图像的滤波器, 见 RESAMPLE_FILTERS
+        use_draft: JPEG图像以不小于目标尺寸的最低分辨率解码 (PIL draft模式)
+        image_format: 拼接图像的编码格式, PNG 或 JPEG
+        """
+        if resample not in RESAMPLE_FILTERS:
+            raise ValueError(f"Unknown resample filter: {resample}, choose from {list(RESAMPLE_FILTERS)}")
+        if image_format not in ("PNG", "JPEG"):
+            raise ValueError(f"Unknown image format: {image_format}, choose from PNG or JPEG")
+        
+        self.resample = resample
+        self.use_draft = use_draft
+        self.image_format = image_format
+        self.jpeg_quality = jpeg_quality
+        
         # Functional relationship标准化映射
         self.func_rel_mapping = {
             "open or close": "openorclose",
@@ -26,9 +68,16 @@ class SceneGraphProcessor:
             "activate": "activate"
         }
     
-    def find_all_scenes(self, base_folders):
-        """递归查找所有场景文件夹"""
+    def find_all_scenes(self, base_folders, dir_index=None):
+        """递归查找所有场景文件夹
+        
+        dir_index: 上次遍历记录的目录信息, 给定时增量遍历, mtime未变的目录不再列出其内容
+                   遍历后原地更新为本次遍历到的目录
+        """
         all_scenes = []
+        previous_dir_index = dict(dir_index) if dir_index is not None else None
+        if dir_index is not None:
+            dir_index.clear()
         
         for base_folder in base_folders:
             if not os.path.exists(base_folder):
@@ -39,6 +88,8 @@ class SceneGraphProcessor:
                 # Real数据: /code/real/multiview_subgraphs/1bathroom/uuid/
                 pattern = os.path.join(base_folder, "multiview_subgraphs", "*", "*")
                 scenes = glob.glob(pattern)
+            elif dir_index is not None:
+                scenes = self.walk_scene_folders(base_folder, previous_dir_index, dir_index)
             else:
                 # Sim数据和新场景数据: 通用方法
                 scenes = []
@@ -55,8 +106,87 @@ class SceneGraphProcessor:
         print(f"🎯 Total scenes found: {len(all_scenes)}")
         return all_scenes
     
-    def load_scene_data(self, scene_folder):
-        """加载单个场景的JSON和图像"""
+    def walk_scene_folders(self, base_folder, previous_dir_index, dir_index):
+        """增量遍历目录, 目录的mtime不变时复用上次记录的子目录和场景判断, 结果记录到dir_index"""
+        scenes = []
+        stack = [base_folder]
+        while stack:
+            folder = stack.pop()
+            mtime = os.stat(folder).st_mtime_ns
+            cached = previous_dir_index.get(folder)
+            if cached is None or cached["mtime"] != mtime:
+                entries = list(os.scandir(folder))
+                subdirs = sorted(entry.name for entry in entries if entry.is_dir())
+                # 检查是否包含JSON和rgb文件夹
+                has_json = any(entry.name.endswith('.json') and entry.is_file() for entry in entries)
+                cached = {"mtime": mtime, "subdirs": subdirs, "is_scene": has_json and 'rgb' in subdirs}
+            
+            dir_index[folder] = cached
+            if cached["is_scene"]:
+                scenes.append(folder)
+            
+            stack.extend(os.path.join(folder, subdir) for subdir in reversed(cached["subdirs"]))
+        
+        return scenes
+    
+    def index_scene(self, scene_folder, cached=None):
+        """记录场景的JSON文件, JSON哈希和图像列表, 场景目录, JSON和rgb目录的mtime不变时复用cached"""
+        rgb_folder = os.path.join(scene_folder, 'rgb')
+        json_file = cached["json_file"] if cached else None
+        mtimes = [get_mtime(scene_folder), get_mtime(json_file), get_mtime(rgb_folder)]
+        if cached and cached["mtimes"] == mtimes:
+            return cached
+        
+        json_files = glob.glob(os.path.join(scene_folder, "*.json"))
+        json_file = json_files[0] if json_files else None  # 取第一个
+        json_hash = None
+        if json_file is not None:
+            with open(json_file, 'rb') as f:
+                json_hash = hashlib.sha1(f.read()).hexdigest()
+        
+        image_files = glob.glob(os.path.join(rgb_folder, "*.jpg")) + \
+                      glob.glob(os.path.join(rgb_folder, "*.png"))
+        images = sorted(os.path.basename(image_file) for image_file in image_files)
+        # 场景版本: JSON内容或图像列表改变时才需要重新处理
+        version = hashlib.sha1(json.dumps([json_hash, images]).encode()).hexdigest()
+        return {
+            "json_file": json_file,
+            "json_hash": json_hash,
+            "images": images,
+            "mtimes": [get_mtime(scene_folder), get_mtime(json_file), get_mtime(rgb_folder)],
+            "version": version
+        }
+    
+    def update_scene_index(self, base_folders, output_dir):
+        """增量更新 output_dir 下的场景索引, 返回当前所有场景的索引"""
+        index_file = os.path.join(output_dir, SCENE_INDEX_FILE)
+        index = load_json(index_file, {"dirs": {}, "scenes": {}})
+        all_scenes = self.find_all_scenes(base_folders, dir_index=index["dirs"])
+        
+        # 只保留仍存在的场景
+        scenes = {}
+        for scene_folder in tqdm(all_scenes, desc="Indexing scenes"):
+            scenes[scene_folder] = self.index_scene(scene_folder, index["scenes"].get(scene_folder))
+        
+        index["scenes"] = scenes
+        save_json(index_file, index)
+        return index
+    
+    def load_scene_data(self, scene_folder, scene_index=None):
+        """加载单个场景的JSON和图像, 给定场景索引时不再查找文件"""
+        if scene_index is not None:
+            if scene_index["json_file"] is None:
+                raise FileNotFoundError(f"No JSON file in {scene_folder}")
+            
+            with open(scene_index["json_file"], 'r', encoding='utf-8') as f:
+                scene_data = json.load(f)
+            
+            rgb_folder = os.path.join(scene_folder, 'rgb')
+            if not scene_index["images"]:
+                raise FileNotFoundError(f"No images in {rgb_folder}")
+            
+            return scene_data, [os.path.join(rgb_folder, image) for image in scene_index["images"]]
+        
         # 找JSON文件
         json_files = glob.glob(os.path.join(scene_folder, "*.json"))
         if not json_files:
@@ -161,7 +291,7 @@ class SceneGraphProcessor:
         if not image_files:
             return None
         
-        # 读取图片
+        # 读取图片 (只读取文件头, 像素在resize时才解码)
         images = []
         for img_path in image_files:
             img = Image.open(img_path)
@@ -200,8 +330,7 @@ class SceneGraphProcessor:
             ratio = min(available_width / img.width, available_height / img.height)
             new_width = int(img.width * ratio)
             new_height = int(img.height * ratio)
-            img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
-            resized_images.append(img)
+            resized_images.append(self.load_resized_image(img, (new_width, new_height)))
         
         # 创建网格
         grid_width = cols * cell_width
@@ -226,34 +355,55 @@ class SceneGraphProcessor:
         
         return grid_img
     
+    def load_resized_image(self, img, size):
+        """解码图像并缩放到size, JPEG图像先以不小于size的最低分辨率(1/2, 1/4, 1/8)解码"""
+        if self.use_draft:
+            img.draft(img.mode, size)  # 非JPEG图像不做处理
+        
+        resized_img = img.resize(size, RESAMPLE_FILTERS[self.resample])
+        img.close()
+        return resized_img
+    
+    def encode_image(self, img):
+        """将图像编码为bytes, 以datasets Image特征的格式返回"""
+        buffer = io.BytesIO()
+        if self.image_format == "JPEG":
+            img.save(buffer, format="JPEG", quality=self.jpeg_quality)
+        else:
+            img.save(buffer, format="PNG")
+        
+        return {"bytes": buffer.getvalue(), "path": None}
+    
+    def build_entry(self, scene_folder, scene_index=None):
+        """处理单个场景，返回数据集条目，失败时抛出异常"""
+        # 加载数据
+        scene_data, image_files = self.load_scene_data(scene_folder, scene_index)
+        
+        # 如果是列表，取第一个元素
+        if isinstance(scene_data, list):
+            scene_data = scene_data[0]
+        
+        # 简化图结构
+        simplified_graph = self.simplify_graph_structure(scene_data)
+        
+        # 拼接图像
+        concat_image = self.concatenate_images(image_files)
+        if concat_image is None:
+            raise ValueError(f"Failed to concatenate images for {scene_folder}")
+        
+        # 构建数据集条目, 图像只编码一次
+        entry = {
+            "images": [self.encode_image(concat_image)],
+            "problem": f"<image>Task instruction: {simplified_graph['task_instruction']}",
+            "answer": json.dumps(simplified_graph, ensure_ascii=False)
+        }
+        
+        return entry
+    
     def process_single_scene(self, scene_folder):
         """处理单个场景，返回数据集条目"""
         try:
-            # 加载数据
-            scene_data, image_files = self.load_scene_data(scene_folder)
-            
-            # 如果是列表，取第一个元素
-            if isinstance(scene_data, list):
-                scene_data = scene_data[0]
-            
-            # 简化图结构
-            simplified_graph = self.simplify_graph_structure(scene_data)
-            
-            # 拼接图像
-            concat_image = self.concatenate_images(image_files)
-            if concat_image is None:
-                print(f"❌ Failed to concatenate images for {scene_folder}")
-                return None
-            
-            # 构建数据集条目
-            entry = {
-                "images": [concat_image],
-                "problem": f"<image>Task instruction: {simplified_graph['task_instruction']}",
-                "answer": json.dumps(simplified_graph, ensure_ascii=False)
-            }
-            
-            return entry
-            
+            return self.build_entry(scene_folder)
         except Exception as e:
             print(f"❌ Error processing {scene_folder}: {e}")
             return None
@@ -278,6 +428,111 @@ class SceneGraphProcessor:
         print(f"✅ Successfully processed {len(processed_data)} scenes")
         return processed_data
     
+    def process_all_scenes_to_shards(self, base_folders, output_dir, num_workers=None, shard_size=256,
+                                     max_samples=None, retry_failed=False):
+        """多进程处理所有场景，并将结果流式写入分片parquet文件
+        
+        每写完一个分片就记录进度到 progress.json，中断后重新运行会跳过已完成的场景。
+        失败的场景及其错误信息也记录在 progress.json 中，而不是打印出来。
+        """
+        os.makedirs(output_dir, exist_ok=True)
+        scene_index = self.update_scene_index(base_folders, output_dir)["scenes"]
+        all_scenes = list(scene_index)
+        if max_samples:
+            all_scenes = all_scenes[:max_samples]
+            print(f"🔬 Processing first {max_samples} scenes for testing")
+        
+        progress = load_progress(output_dir)
+        if retry_failed:
+            progress["failed"] = {}
+        
+        # 跳过已完成(和已失败)的场景, 新增或修改过的场景版本不同, 需要重新处理
+        finished = {}
+        for shard in progress["shards"]:
+            finished.update(zip(shard["scenes"], shard["versions"]))
+        
+        for scene_folder, failure in progress["failed"].items():
+            finished.setdefault(scene_folder, failure["version"])
+        
+        pending = [scene for scene in all_scenes if finished.get(scene) != scene_index[scene]["version"]]
+        print(f"⏩ Skipping {len(all_scenes) - len(pending)} finished scenes, {len(pending)} scenes to process")
+        
+        buffer, buffer_scenes, buffer_versions = [], [], []
+        num_processed = 0
+        num_workers = num_workers or os.cpu_count()
+        tasks = [(scene_folder, scene_index[scene_folder]) for scene_folder in pending]
+        worker = partial(process_scene_worker, self)
+        max_in_flight = num_workers * 2
+        task_iter = iter(tasks)
+        in_flight = deque()
+        with multiprocessing.Pool(num_workers) as pool, tqdm(total=len(tasks), desc="Processing scenes") as pbar:
+            while True:
+                # 最多同时提交 max_in_flight 个任务, 主进程写分片时子进程不会无限堆积结果,
+                # 内存中最多保留一个分片的条目和 max_in_flight 个场景的结果
+                for task in islice(task_iter, max_in_flight - len(in_flight)):
+                    in_flight.append(pool.apply_async(worker, (task,)))
+                
+                if not in_flight:
+                    break
+                
+                scene_folder, entry, error = in_flight.popleft().get()
+                pbar.update(1)
+                version = scene_index[scene_folder]["version"]
+                if entry is None:
+                    progress["failed"][scene_folder] = {"version": version, "error": error}
+                    continue
+                
+                progress["failed"].pop(scene_folder, None)
+                num_processed += 1
+                buffer.append(entry)
+                buffer_scenes.append(scene_folder)
+                buffer_versions.append(version)
+                if len(buffer) >= shard_size:
+                    write_shard(output_dir, progress, buffer, buffer_scenes, buffer_versions)
+                    buffer, buffer_scenes, buffer_versions = [], [], []
+        
+        if buffer:
+            write_shard(output_dir, progress, buffer, buffer_scenes, buffer_versions)
+        else:
+            save_progress(output_dir, progress)
+        
+        print(f"✅ Successfully processed {num_processed} new or changed scenes, "
+              f"{len(progress['shards'])} shards in total")
+        if progress["failed"]:
+            print(f"⚠️ {len(progress['failed'])} scenes failed, see {os.path.join(output_dir, PROGRESS_FILE)}")
+        
+        return progress
+    
+    def create_dataset_from_shards(self, output_dir, train_ratio=0.95, seed=42):
+        """从分片文件创建训练和验证数据集, 只保留每个场景当前版本的条目"""
+        progress = load_progress(output_dir)
+        scene_index = load_json(os.path.join(output_dir, SCENE_INDEX_FILE), {"scenes": {}})["scenes"]
+        data_files = [os.path.join(output_dir, shard["file"]) for shard in progress["shards"]]
+        dataset = load_dataset("parquet", data_files=data_files, split="train")
+        
+        # 修改过的场景在后面的分片中有新条目, 删除的场景不在索引中
+        latest = {}
+        row = 0
+        for shard in progress["shards"]:
+            for scene_folder, version in zip(shard["scenes"], shard["versions"]):
+                if scene_folder in scene_index and scene_index[scene_folder]["version"] == version:
+                    latest[scene_folder] = row
+                
+                row += 1
+        
+        dataset = dataset.select(sorted(latest.values())).shuffle(seed=seed)
+        
+        # 分割
+        train_size = int(len(dataset) * train_ratio)
+        print(f"📊 Dataset split: {train_size} train, {len(dataset) - train_size} validation")
+        
+        dataset_dict = DatasetDict({
+            "train": dataset.select(list(range(train_size))),
+            "validation": dataset.select(list(range(train_size, len(dataset))))
+        })
+        
+        return dataset_dict
+    
     def create_dataset(self, processed_data, train_ratio=0.95):
         """创建训练和验证数据集"""
         # 随机打乱
@@ -293,8 +548,8 @@ class SceneGraphProcessor:
         print(f"📊 Dataset split: {len(train_data)} train, {len(val_data)} validation")
         
         # 创建Dataset对象
-        train_dataset = Dataset.from_list(train_data)
-        val_dataset = Dataset.from_list(val_data)
+        train_dataset = Dataset.from_list(train_data, features=SHARD_FEATURES)
+        val_dataset = Dataset.from_list(val_data, features=SHARD_FEATURES)
         
         # 创建DatasetDict
         dataset_dict = DatasetDict({
@@ -304,8 +559,76 @@ class SceneGraphProcessor:
         
         return dataset_dict
 
+def process_scene_worker(processor, task):
+    """子进程中处理单个场景，返回 (场景, 条目, 错误信息)"""
+    scene_folder, scene_index = task
+    try:
+        entry = processor.build_entry(scene_folder, scene_index)
+    except Exception:
+        return scene_folder, None, traceback.format_exc()
+    
+    return scene_folder, entry, None
+
+
+def get_mtime(path):
+    """文件或目录的mtime, 不存在时返回None"""
+    try:
+        return os.stat(path).st_mtime_ns
+    except (FileNotFoundError, TypeError):
+        return None
+
+
+def load_json(path, default):
+    """读取json文件，不存在时返回default"""
+    if not os.path.exists(path):
+        return default
+    
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_json(path, data):
+    """原子地写入json文件"""
+    with open(path + ".tmp", 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    
+    os.replace(path + ".tmp", path)
+
+
+def load_progress(output_dir):
+    """读取处理进度，不存在时返回空进度"""
+    return load_json(os.path.join(output_dir, PROGRESS_FILE), {"shards": [], "failed": {}})
+
+
+def save_progress(output_dir, progress):
+    """原子地写入处理进度"""
+    save_json(os.path.join(output_dir, PROGRESS_FILE), progress)
+
+
+def write_shard(output_dir, progress, entries, scenes, versions):
+    """写入一个分片，并在写完后记录进度"""
+    shard_file = f"shard-{len(progress['shards']):05d}.parquet"
+    shard_path = os.path.join(output_dir, shard_file)
+    Dataset.from_list(entries, features=SHARD_FEATURES).to_parquet(shard_path + ".tmp")
+    os.replace(shard_path + ".tmp", shard_path)
+    progress["shards"].append({"file": shard_file, "scenes": scenes, "versions": versions})
+    save_progress(output_dir, progress)
+
+
 # 测试代码
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Scene Graph Dataset Processor")
+    parser.add_argument("--output_dir", default="/code/scenes/data_extended")
+    parser.add_argument("--shard_dir", default="/code/scenes/data_extended_shards", help="分片和进度文件目录")
+    parser.add_argument("--num_workers", default=None, type=int, help="默认使用所有CPU")
+    parser.add_argument("--shard_size", default=256, type=int, help="每个分片的场景数")
+    parser.add_argument("--max_samples", default=None, type=int)
+    parser.add_argument("--retry_failed", action="store_true", help="重新处理之前失败的场景")
+    parser.add_argument("--resample", default="lanczos", choices=list(RESAMPLE_FILTERS), help="缩放滤波器")
+    parser.add_argument("--no_draft", action="store_true", help="完整解码JPEG图像后再缩放")
+    parser.add_argument("--image_format", default="PNG", choices=["PNG", "JPEG"], help="拼接图像的编码格式")
+    args = parser.parse_args()
+    
     # 设置随机种子
     random.seed(42)
     
@@ -320,18 +643,27 @@ if __name__ == "__main__":
     ]
     
     # 创建处理器
-    processor = SceneGraphProcessor()
+    processor = SceneGraphProcessor(
+        resample=args.resample, use_draft=not args.no_draft, image_format=args.image_format
+    )
     
     print("🚀 Scene Graph Dataset Processor")
     print("=" * 50)
     
-    # 处理所有场景（包括新数据）
+    # 处理所有场景（包括新数据）, 中断后重新运行会从上次的进度继续
     print("🚀 Processing all scenes including new data...")
-    processed_data = processor.process_all_scenes(base_folders)
+    progress = processor.process_all_scenes_to_shards(
+        base_folders,
+        args.shard_dir,
+        num_workers=args.num_workers,
+        shard_size=args.shard_size,
+        max_samples=args.max_samples,
+        retry_failed=args.retry_failed
+    )
     
-    if processed_data:
+    if progress["shards"]:
         # 创建数据集
-        dataset = processor.create_dataset(processed_data)
+        dataset = processor.create_dataset_from_shards(args.shard_dir)
         
         # 打印样本
         print("\n📋 Sample data:")
@@ -339,15 +671,15 @@ if __name__ == "__main__":
         print(f"Answer: {dataset['train'][0]['answer'][:200]}...")
         
         # 保存完整数据集
-        dataset.save_to_disk("/code/scenes/data_extended")
-        print("💾 Extended dataset saved to /code/scenes/data_extended")
+        dataset.save_to_disk(args.output_dir)
+        print(f"💾 Extended dataset saved to {args.output_dir}")
         
         print("✅ Data processing completed!")
         print(f"📊 Total: {len(dataset['train'])} train, {len(dataset['validation'])} validation")
         
         # 提示下一步
         print("\nNext steps:")
-        print("1. Update training script to use /code/scenes/data_extended")
+        print(f"1. Update training script to use {args.output_dir}")
         print("2. Or upload to HuggingFace: dataset.push_to_hub('cheryyunl/scene_graph_extended')")
     else:
         print("❌ No data processed successfully!")
@@ -14,80 +14,138 @@
 
 import re
 import json
-from typing import Any, Dict, List
+from functools import lru_cache
+from typing import Any, Dict, FrozenSet, List, Optional, Tuple
+
+import numpy as np
+from scipy.optimize import linear_sum_assignment
 
 # Valid values from the dataset
 VALID_ACTION_TYPES = {"press", "rotate", "pull", "open", "push", "close", "insert"}
 VALID_FUNCTIONAL_RELATIONSHIPS = {"openorclose", "adjust", "control", "providepower", "activate"}
 VALID_SPATIAL_RELATIONS = {"left_of", "right_of", "in_front_of", "behind", "higher_than", "lower_than", "close", "far", "touching"}
+REQUIRED_FIELDS = ("task_instruction", "nodes", "edges", "action_type", "function_type")
+REQUIRED_EDGE_FIELDS = ("functional_relationship", "object1", "object2", "spatial_relations", "is_touching")
+
+ANSWER_MARKER_PATTERN = re.compile(r"Answer\s*:\s*\{")
+JSON_STRUCTURE_PATTERN = re.compile(r'[{}\[\]"]')
+JSON_STRING_TAIL_PATTERN = re.compile(r'[^"\\]*(?:\\.[^"\\]*)*"', re.DOTALL)
+MAX_JSON_DEPTH = 32
+
+def find_json_object_end(text: str, start: int) -> Optional[int]:
+    """Brace-match the JSON object starting at `text[start]`, return the end index or None if unbalanced."""
+    depth = 0
+    pos = start
+    while True:
+        match = JSON_STRUCTURE_PATTERN.search(text, pos)
+        if match is None:
+            return None
+
+        char = match.group()
+        pos = match.end()
+        if char == '"':  # skip the string so that braces in it are not counted
+            match = JSON_STRING_TAIL_PATTERN.match(text, pos)
+            if match is None:
+                return None
+
+            pos = match.end()
+        elif char in "{[":
+            depth += 1
+            if depth > MAX_JSON_DEPTH:
+                return None
+        else:
+            depth -= 1
+            if depth == 0:
+                return pos
 
-def extract_answer_json(response: str) -> Dict:
+def scan_answer_json(response: str) -> Tuple[Optional[Tuple[int, int]], Optional[Dict]]:
+    """Find the JSON object after the last `Answer:` marker, return its span and the parsed object.
+
+    The marker is searched backwards and the object is brace-matched forwards, so the cost stays linear
+    in the response length even for truncated or deeply nested outputs.
+    """
+    pos = len(response)
+    while True:
+        pos = response.rfind("Answer", 0, pos)
+        if pos == -1:
+            return None, None
+
+        match = ANSWER_MARKER_PATTERN.match(response, pos)
+        if match is not None:
+            break
+
+    start = match.end() - 1
+    end = find_json_object_end(response, start)
+    if end is None:
+        return None, None
+
+    try:
+        return (start, end), json.loads(response[start:end])
+    except json.JSONDecodeError:
+        return None, None
+
+def extract_answer_json(response: str) -> Optional[Dict]:
     """Extract JSON from Answer: field in response."""
-    match = re.search(r"Answer\s*:\s*(\{.*\})", response, re.DOTALL)
-    if not match:
-        return None
-    
+    return scan_answer_json(response)[1]
+
+def parse_ground_truth(ground_truth: str) -> Optional[Dict]:
+    """Parse ground truth JSON, return None if it is invalid."""
     try:
-        json_str = match.group(1).strip()
-        return json.loads(json_str)
+        return json.loads(ground_truth.strip())
     except json.JSONDecodeError:
         return None
 
-def format_reward(response: str) -> float:
-    """Check if prediction follows correct format with valid JSON structure."""
-    # 1. Check basic Answer: format
-    if not re.search(r"Answer\s*:\s*\{", response):
-        return 0.0
+def is_valid_answer_json(answer_json: Optional[Dict]) -> bool:
+    """Check if an extracted answer has the required fields, types and enum values."""
+    if not isinstance(answer_json, dict):
+        return False
     
-    # 2. Extract and parse JSON
-    answer_json = extract_answer_json(response)
-    if answer_json is None:
-        return 0.0
+    # 1. Check required fields
+    if not all(field in answer_json for field in REQUIRED_FIELDS):
+        return False
     
-    # 3. Check required fields
-    required_fields = ["task_instruction", "nodes", "edges", "action_type", "function_type"]
-    if not all(field in answer_json for field in required_fields):
-        return 0.0
-    
-    # 4. Check data types
+    # 2. Check data types
     if not isinstance(answer_json.get("nodes"), list):
-        return 0.0
+        return False
     if not isinstance(answer_json.get("edges"), list):
-        return 0.0
+        return False
     if not isinstance(answer_json.get("task_instruction"), str):
-        return 0.0
+        return False
     
-    # 5. Check valid enum values
+    # 3. Check valid enum values
     if answer_json.get("action_type") not in VALID_ACTION_TYPES:
-        return 0.0
+        return False
     
-    # 6. Check edges structure
+    # 4. Check edges structure
     for edge in answer_json.get("edges", []):
         if not isinstance(edge, dict):
-            return 0.0
+            return False
         
-        required_edge_fields = ["functional_relationship", "object1", "object2", "spatial_relations", "is_touching"]
-        if not all(field in edge for field in required_edge_fields):
-            return 0.0
+        if not all(field in edge for field in REQUIRED_EDGE_FIELDS):
+            return False
         
         # Check functional relationship validity
         if edge.get("functional_relationship") not in VALID_FUNCTIONAL_RELATIONSHIPS:
-            return 0.0
+            return False
         
         # Check spatial relations
         spatial_rels = edge.get("spatial_relations", [])
         if not isinstance(spatial_rels, list):
-            return 0.0
+            return False
         
         for rel in spatial_rels:
             if rel not in VALID_SPATIAL_RELATIONS:
-                return 0.0
+                return False
         
         # Check is_touching is boolean
         if not isinstance(edge.get("is_touching"), bool):
-            return 0.0
+            return False
     
-    return 1.0
+    return True
+
+def format_reward(response: str) -> float:
+    """Check if prediction follows correct format with valid JSON structure."""
+    return 1.0 if is_valid_answer_json(extract_answer_json(response)) else 0.0
 
 def normalize_object_name(obj_name):
     if isinstance(obj_name, str) and '/' in obj_name:
@@ -95,15 +153,102 @@ def normalize_object_name(obj_name):
         return parts
     return [obj_name]
 
+def _hashable(value):
+    """Make JSON values (lists, dicts) usable as set members and dict keys."""
+    try:
+        hash(value)
+        return value
+    except TypeError:
+        return ("__json__", json.dumps(value, sort_keys=True, default=str))
+
+@lru_cache(maxsize=65536)
+def _normalized_name_set(obj_name: str) -> FrozenSet:
+    return frozenset(normalize_object_name(obj_name))
+
+def object_name_set(obj_name) -> FrozenSet:
+    """Set of names an object can be matched by, cached for string names."""
+    if isinstance(obj_name, str):
+        return _normalized_name_set(obj_name)
+    return frozenset([_hashable(obj_name)])
+
+def relation_set(relations) -> FrozenSet:
+    try:
+        return frozenset(_hashable(rel) for rel in relations)
+    except TypeError:
+        return frozenset()
+
 def objects_match(pred_obj, gt_obj):
-    pred_names = normalize_object_name(pred_obj)
-    gt_names = normalize_object_name(gt_obj)
+    return not object_name_set(pred_obj).isdisjoint(object_name_set(gt_obj))
+
+def incidence_matrices(*set_lists: List[FrozenSet]) -> List[np.ndarray]:
+    """One-hot encode lists of sets over a shared vocabulary, so that A @ B.T gives pairwise overlaps."""
+    vocab = {}
+    encoded = []
+    for sets in set_lists:
+        rows, cols = [], []
+        for i, items in enumerate(sets):
+            for item in items:
+                rows.append(i)
+                cols.append(vocab.setdefault(item, len(vocab)))
+        encoded.append((len(sets), rows, cols))
+    
+    matrices = []
+    for num_rows, rows, cols in encoded:
+        matrix = np.zeros((num_rows, len(vocab)), dtype=np.float64)
+        matrix[rows, cols] = 1.0
+        matrices.append(matrix)
+    return matrices
+
+def equal_matrix(pred_values: List[Any], gt_values: List[Any]) -> np.ndarray:
+    """Pairwise equality of two lists of JSON values."""
+    vocab = {}
+    pred_ids = np.array([vocab.setdefault(_hashable(value), len(vocab)) for value in pred_values], dtype=np.int64)
+    gt_ids = np.array([vocab.setdefault(_hashable(value), len(vocab)) for value in gt_values], dtype=np.int64)
+    return pred_ids[:, None] == gt_ids[None, :]
+
+def max_assignment(weights: np.ndarray) -> float:
+    """Total weight of the optimal one-to-one matching between rows (prediction) and columns (ground truth)."""
+    if weights.size == 0:
+        return 0.0
+    
+    rows, cols = linear_sum_assignment(weights, maximize=True)
+    return float(weights[rows, cols].sum())
+
+def edge_similarity_matrix(pred_edges: List[Dict], gt_edges: List[Dict]) -> np.ndarray:
+    """Vectorized calculate_edge_similarity for every (predicted, ground truth) edge pair."""
+    # Object matching (bidirectional, 考虑斜杠分隔的情况)
+    pred_obj1 = [object_name_set(edge.get("object1")) for edge in pred_edges]
+    pred_obj2 = [object_name_set(edge.get("object2")) for edge in pred_edges]
+    gt_obj1 = [object_name_set(edge.get("object1")) for edge in gt_edges]
+    gt_obj2 = [object_name_set(edge.get("object2")) for edge in gt_edges]
+    pred_obj1, pred_obj2, gt_obj1, gt_obj2 = incidence_matrices(pred_obj1, pred_obj2, gt_obj1, gt_obj2)
+    match1 = (pred_obj1 @ gt_obj1.T > 0) & (pred_obj2 @ gt_obj2.T > 0)
+    match2 = (pred_obj1 @ gt_obj2.T > 0) & (pred_obj2 @ gt_obj1.T > 0)
+    object_score = (match1 | match2).astype(np.float64)
+    
+    # Functional relationship
+    functional_score = equal_matrix(
+        [edge.get("functional_relationship") for edge in pred_edges],
+        [edge.get("functional_relationship") for edge in gt_edges],
+    ).astype(np.float64)
+    
+    # Spatial relations (IoU, zero if ground truth has no relations)
+    pred_spatial = [relation_set(edge.get("spatial_relations", [])) for edge in pred_edges]
+    gt_spatial = [relation_set(edge.get("spatial_relations", [])) for edge in gt_edges]
+    pred_incidence, gt_incidence = incidence_matrices(pred_spatial, gt_spatial)
+    intersection = pred_incidence @ gt_incidence.T
+    pred_size = np.array([len(rels) for rels in pred_spatial], dtype=np.float64)
+    gt_size = np.array([len(rels) for rels in gt_spatial], dtype=np.float64)
+    union = pred_size[:, None] + gt_size[None, :] - intersection
+    spatial_score = np.divide(intersection, union, out=np.zeros_like(intersection), where=union > 0)
+    
+    # Is touching
+    touching_score = equal_matrix(
+        [edge.get("is_touching") for edge in pred_edges],
+        [edge.get("is_touching") for edge in gt_edges],
+    ).astype(np.float64)
     
-    for pred_name in pred_names:
-        for gt_name in gt_names:
-            if pred_name == gt_name:
-                return True
-    return False
+    return (object_score + functional_score + spatial_score + touching_score) / 4.0
 
 def calculate_graph_similarity(pred_json: Dict, gt_json: Dict) -> float:
     """Calculate similarity between predicted and ground truth graph structures."""
@@ -133,19 +278,14 @@ def calculate_graph_similarity(pred_json: Dict, gt_json: Dict) -> float:
     pred_nodes = pred_json.get("nodes", [])
     gt_nodes = gt_json.get("nodes", [])
     if gt_nodes:
-        # 计算匹配的节点数，考虑斜杠分隔的情况
-        matched_pred = set()
-        matched_gt = set()
-        
-        for i, pred_node in enumerate(pred_nodes):
-            for j, gt_node in enumerate(gt_nodes):
-                if objects_match(pred_node, gt_node) and i not in matched_pred and j not in matched_gt:
-                    matched_pred.add(i)
-                    matched_gt.add(j)
-                    break
+        # 最大匹配的节点数，考虑斜杠分隔的情况
+        pred_incidence, gt_incidence = incidence_matrices(
+            [object_name_set(node) for node in pred_nodes], [object_name_set(node) for node in gt_nodes]
+        )
+        node_match = pred_incidence @ gt_incidence.T > 0
         
         # 使用IoU计算相似度
-        intersection = len(matched_pred)  # 匹配的数量
+        intersection = round(max_assignment(node_match.astype(np.float64)))  # 匹配的数量
         union = len(pred_nodes) + len(gt_nodes) - intersection
         nodes_similarity = intersection / union if union > 0 else 0.0
         total_score += nodes_similarity
@@ -156,14 +296,8 @@ def calculate_graph_similarity(pred_json: Dict, gt_json: Dict) -> float:
     gt_edges = gt_json.get("edges", [])
     
     if gt_edges:
-        edge_score = 0.0
-        for gt_edge in gt_edges:
-            best_match = 0.0
-            for pred_edge in pred_edges:
-                edge_sim = calculate_edge_similarity(pred_edge, gt_edge)
-                best_match = max(best_match, edge_sim)
-            edge_score += best_match
-        edge_score /= len(gt_edges)
+        # Each predicted edge can match at most one ground truth edge
+        edge_score = max_assignment(edge_similarity_matrix(pred_edges, gt_edges)) / len(gt_edges)
         
         # Penalize extra edges
         if len(pred_edges) > len(gt_edges):
@@ -214,29 +348,8 @@ def calculate_edge_similarity(pred_edge: Dict, gt_edge: Dict) -> float:
     
     return score / components
 
-def accuracy_reward(response: str, ground_truth: str) -> float:
-    """Calculate accuracy reward by comparing predicted and ground truth graphs."""
-    # Extract JSON from response
-    pred_json = extract_answer_json(response)
-    
-    # Parse ground truth JSON
-    try:
-        gt_json = json.loads(ground_truth.strip())
-    except json.JSONDecodeError:
-        return -0.5
-    
-    # If failed to extract JSON, return negative reward
-    if pred_json is None:
-        return -0.5
-    
-    # If format validation fails (invalid enum values etc), give 0 accuracy
-    if format_reward(response) == 0.0:
-        return 0.0
-    
-    # Calculate similarity
-    similarity = calculate_graph_similarity(pred_json, gt_json)
-    
-    # Convert to DAPO-style reward with finer granularity
+def similarity_to_reward(similarity: float) -> float:
+    """Convert graph similarity to DAPO-style reward with finer granularity."""
     if similarity >= 0.98:  # Very strict for perfect score
         return 1.0
     elif similarity >= 0.85:
@@ -250,6 +363,23 @@ def accuracy_reward(response: str, ground_truth: str) -> float:
     else:
         return -0.5
 
+def parsed_accuracy_reward(pred_json: Optional[Dict], gt_json: Optional[Dict], is_valid: bool) -> float:
+    """Calculate accuracy reward from an already extracted answer and parsed ground truth."""
+    # If ground truth or answer JSON is missing, return negative reward
+    if gt_json is None or pred_json is None:
+        return -0.5
+    
+    # If format validation fails (invalid enum values etc), give 0 accuracy
+    if not is_valid:
+        return 0.0
+    
+    return similarity_to_reward(calculate_graph_similarity(pred_json, gt_json))
+
+def accuracy_reward(response: str, ground_truth: str) -> float:
+    """Calculate accuracy reward by comparing predicted and ground truth graphs."""
+    pred_json = extract_answer_json(response)
+    return parsed_accuracy_reward(pred_json, parse_ground_truth(ground_truth), is_valid_answer_json(pred_json))
+
 def soft_overlong_punishment(response_length: int, max_response_length: int, overlong_buffer_length: int) -> float:
     """Apply soft length penalty for overly long responses."""
     expected_len = max_response_length - overlong_buffer_length
@@ -272,14 +402,22 @@ def compute_score(
         raise ValueError("Please use `reward_type=batch` for dapo_graph reward function.")
 
     scores = []
+    gt_cache: Dict[str, Optional[Dict]] = {}  # responses in a group share the same ground truth
     for reward_input in reward_inputs:
         response = reward_input["response"]
+        ground_truth = reward_input["ground_truth"]
+        if ground_truth not in gt_cache:
+            gt_cache[ground_truth] = parse_ground_truth(ground_truth)
+        
+        # Extract and validate the answer once, then reuse it for every score
+        pred_json = extract_answer_json(response)
+        is_valid = is_valid_answer_json(pred_json)
         
         # Format validation (JSON structure check)
-        format_score = format_reward(response)
+        format_score = 1.0 if is_valid else 0.0
         
         # Content accuracy (graph structure similarity)
-        accuracy_score = accuracy_reward(response, reward_input["ground_truth"])
+        accuracy_score = parsed_accuracy_reward(pred_json, gt_cache[ground_truth], is_valid)
         
         # Length control
         overlong_score = soft_overlong_punishment(
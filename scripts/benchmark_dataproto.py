@@ -0,0 +1,121 @@
+# Copyright 2024 Bytedance Ltd. and/or its affiliates
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Benchmark the serialization of a rollout-sized DataProto, comparing the torch.save based format
+with the out-of-band buffer format.
+
+Example:
+    python scripts/benchmark_dataproto.py --batch_size 1024 --prompt_length 2048 --response_length 4096 --ray
+"""
+
+import argparse
+import io
+import os
+import pickle
+import sys
+import time
+from typing import Callable
+
+import numpy as np
+import torch
+
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from verl.protocol import DataProto  # noqa: E402
+
+
+class LegacyDataProto(DataProto):
+    """DataProto serialized by torch.save, as in previous versions."""
+
+    def __getstate__(self):
+        batch_to_save = self.batch.contiguous().consolidate() if self.batch is not None else None
+        buffer = io.BytesIO()
+        torch.save(batch_to_save, buffer)
+        return buffer.getvalue(), self.non_tensor_batch, self.meta_info
+
+
+def make_batch(args: argparse.Namespace, cls: type[DataProto]) -> DataProto:
+    """A batch with the keys of a rollout batch, including 3d mrope position ids."""
+    seqlen = args.prompt_length + args.response_length
+    batch_size, response_length = args.batch_size, args.response_length
+    tensors = {
+        "input_ids": torch.randint(0, 150000, (batch_size, seqlen)),
+        "attention_mask": torch.ones(batch_size, seqlen, dtype=torch.int64),
+        "position_ids": torch.arange(seqlen).expand(batch_size, 3, seqlen).contiguous(),
+        "responses": torch.randint(0, 150000, (batch_size, response_length)),
+        "response_mask": torch.ones(batch_size, response_length, dtype=torch.int64),
+        "old_log_probs": torch.randn(batch_size, response_length),
+        "ref_log_probs": torch.randn(batch_size, response_length),
+        "advantages": torch.randn(batch_size, response_length),
+    }
+    non_tensors = {"uid": np.array([f"uid-{i // 8}" for i in range(batch_size)], dtype=object)}
+    return cls.from_dict(tensors=tensors, non_tensors=non_tensors, meta_info={"temperature": 1.0})
+
+
+def measure(fn: Callable[[], None], repeats: int) -> float:
+    fn()  # warm up
+    start_time = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+
+    return (time.perf_counter() - start_time) / repeats
+
+
+def pickle_in_band(data: DataProto) -> None:
+    pickle.loads(pickle.dumps(data, protocol=5))
+
+
+def pickle_out_of_band(data: DataProto) -> None:
+    buffers = []
+    payload = pickle.dumps(data, protocol=5, buffer_callback=buffers.append)
+    pickle.loads(payload, buffers=buffers)
+
+
+def ray_put_get(data: DataProto) -> None:
+    import ray
+
+    ray.get(ray.put(data))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--batch_size", default=512, type=int)
+    parser.add_argument("--prompt_length", default=2048, type=int)
+    parser.add_argument("--response_length", default=2048, type=int)
+    parser.add_argument("--repeats", default=3, type=int)
+    parser.add_argument("--ray", action="store_true", help="Also measure ray.put and ray.get on a local cluster")
+    args = parser.parse_args()
+
+    benchmarks = {"pickle in-band": pickle_in_band, "pickle out-of-band": pickle_out_of_band}
+    if args.ray:
+        import ray
+
+        ray.init(num_cpus=1, include_dashboard=False)
+        benchmarks["ray put/get"] = ray_put_get
+
+    size = make_batch(args, DataProto).batch.bytes() / 1024**2
+    print(f"Batch size: {size:.1f} MB")
+    header = f"{'path':<22}{'legacy s':>10}{'current s':>12}{'speedup':>10}"
+    print(header)
+    print("-" * len(header))
+    for name, fn in benchmarks.items():
+        legacy_data, data = make_batch(args, LegacyDataProto), make_batch(args, DataProto)
+        legacy_time = measure(lambda: fn(legacy_data), args.repeats)
+        current_time = measure(lambda: fn(data), args.repeats)
+        print(f"{name:<22}{legacy_time:>10.3f}{current_time:>12.3f}{legacy_time / current_time:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
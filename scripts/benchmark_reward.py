@@ -0,0 +1,287 @@
+# Copyright 2024 Bytedance Ltd. and/or its affiliates
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Benchmark the reward managers with the shipped reward functions on synthetic response corpora.
+
+The responses are tokenized into a DataProto beforehand, and each call of `compute_reward` scores `batch_size`
+responses (decoding, scoring and placing the rewards), like a training step does. The latencies are reported per
+call and per sample, the latter is the latency of the call divided by the number of samples in it.
+
+Example:
+    python scripts/benchmark_reward.py --reward dapo_graph --num_samples 4096 --group_size 8 --max_edges 64
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Optional
+
+import numpy as np
+import torch
+
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from verl.protocol import DataProto  # noqa: E402
+from verl.utils.tokenizer import get_tokenizer  # noqa: E402
+from verl.workers.reward.config import RewardConfig  # noqa: E402
+from verl.workers.reward.function import (  # noqa: E402
+    BatchFunctionRewardManager,
+    FunctionRewardManager,
+    SequentialFunctionRewardManager,
+)
+
+
+REWARD_DIR = os.path.join(os.path.dirname(__file__), "..", "examples", "reward_function")
+REWARD_FUNCTIONS = {
+    "math": ("math.py:compute_score", "batch", {}),
+    "r1v": ("r1v.py:compute_score", "sequential", {}),
+    "dapo": (
+        "dapo.py:compute_score",
+        "batch",
+        {"max_response_length": 2048, "overlong_buffer_length": 512, "overlong_penalty_factor": 1.0},
+    ),
+    "dapo_graph": (
+        "dapo_graph.py:compute_score",
+        "batch",
+        {"max_response_length": 2048, "overlong_buffer_length": 512, "overlong_penalty_factor": 0.5},
+    ),
+}
+WORDS = ("the", "object", "is", "left", "of", "so", "we", "need", "to", "check", "first", "then", "answer", "angle")
+OBJECTS = (
+    "outlet",
+    "toaster",
+    "lamp / light",
+    "switch",
+    "door",
+    "knob / handle",
+    "cabinet",
+    "faucet",
+    "sink",
+    "drawer",
+)
+ACTIONS = ("press", "rotate", "pull", "open", "push", "close", "insert")
+RELATIONSHIPS = ("openorclose", "adjust", "control", "providepower", "activate")
+SPATIAL_RELATIONS = ("left_of", "right_of", "in_front_of", "behind", "higher_than", "lower_than", "close", "far")
+
+
+def filler(rng: random.Random, length: int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(length))
+
+
+def random_graph(rng: random.Random, num_nodes: int, num_edges: int) -> dict[str, Any]:
+    nodes = [rng.choice(OBJECTS) + (f" {i}" if i >= len(OBJECTS) else "") for i in range(num_nodes)]
+    edges = [
+        {
+            "functional_relationship": rng.choice(RELATIONSHIPS),
+            "object1": rng.choice(nodes) if nodes else "outlet",
+            "object2": rng.choice(nodes) if nodes else "toaster",
+            "spatial_relations": rng.sample(SPATIAL_RELATIONS, rng.randint(1, 3)),
+            "is_touching": rng.random() < 0.5,
+        }
+        for _ in range(num_edges)
+    ]
+    return {
+        "task_instruction": filler(rng, 6),
+        "nodes": nodes,
+        "edges": edges,
+        "action_type": rng.choice(ACTIONS),
+        "function_type": rng.choice(("power_supply", "water_flow_control", "lighting")),
+    }
+
+
+def make_ground_truth(reward: str, rng: random.Random, args: argparse.Namespace) -> str:
+    if reward == "dapo_graph":
+        num_nodes = rng.randint(args.min_nodes, args.max_nodes)
+        num_edges = rng.randint(args.min_edges, args.max_edges)
+        return json.dumps(random_graph(rng, num_nodes, num_edges))
+
+    return str(rng.randint(0, 1000))
+
+
+def make_response(reward: str, ground_truth: str, rng: random.Random, args: argparse.Namespace) -> str:
+    text = filler(rng, rng.randint(args.min_length, args.max_length))
+    valid = rng.random() < args.valid_rate
+    correct = rng.random() < args.correct_rate
+    if reward == "dapo_graph":
+        if correct:
+            answer = ground_truth
+        else:
+            gt_json = json.loads(ground_truth)
+            answer = json.dumps(random_graph(rng, len(gt_json["nodes"]), len(gt_json["edges"])))
+
+        if not valid:  # truncated json
+            answer = answer[: rng.randint(1, max(1, len(answer) - 1))]
+
+        return f"{text}\n\nAnswer: {answer}"
+
+    answer = ground_truth if correct else str(rng.randint(1001, 2000))
+    if reward == "math":
+        return f"<think>{text}</think> The answer is \\boxed{{{answer}}}" if valid else f"{text} {answer}"
+    elif reward == "r1v":
+        return f"<think>{text}</think> <answer>{answer}</answer>" if valid else f"{text} {answer}"
+    else:  # dapo
+        return f"{text}\nAnswer: {answer}" if valid else f"{text} {answer}"
+
+
+def make_corpus(reward: str, args: argparse.Namespace) -> list[dict[str, Any]]:
+    """Build groups of `group_size` responses sharing a ground truth, like rollout.n samples of a prompt."""
+    rng = random.Random(args.seed)
+    reward_inputs = []
+    while len(reward_inputs) < args.num_samples:
+        ground_truth = make_ground_truth(reward, rng, args)
+        for _ in range(args.group_size):
+            if len(reward_inputs) > 0 and rng.random() < args.duplicate_rate:
+                response = reward_inputs[-1]["response"]
+            else:
+                response = make_response(reward, ground_truth, rng, args)
+
+            reward_inputs.append({"response": response, "ground_truth": ground_truth})
+
+    return reward_inputs[: args.num_samples]
+
+
+def make_data(reward_inputs: list[dict[str, Any]], tokenizer: Any) -> DataProto:
+    """Tokenize the responses into right-padded responses and response_mask, as the rollout returns them."""
+    response_ids = tokenizer([reward_input["response"] for reward_input in reward_inputs], add_special_tokens=False)
+    response_ids = response_ids["input_ids"]
+    max_length = max(len(ids) for ids in response_ids)
+    pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else 0
+    responses = torch.full((len(response_ids), max_length), pad_token_id, dtype=torch.long)
+    response_mask = torch.zeros((len(response_ids), max_length), dtype=torch.long)
+    for i, ids in enumerate(response_ids):
+        responses[i, : len(ids)] = torch.tensor(ids, dtype=torch.long)
+        response_mask[i, : len(ids)] = 1
+
+    ground_truth = np.array([reward_input["ground_truth"] for reward_input in reward_inputs], dtype=object)
+    return DataProto.from_single_dict(
+        {"responses": responses, "response_mask": response_mask, "ground_truth": ground_truth}
+    )
+
+
+def run_benchmark(reward: str, mode: str, args: argparse.Namespace) -> dict[str, Any]:
+    reward_function, reward_type, reward_function_kwargs = REWARD_FUNCTIONS[reward]
+    config = RewardConfig(
+        reward_type=reward_type,
+        reward_function=os.path.join(REWARD_DIR, reward_function),
+        reward_function_kwargs=reward_function_kwargs,
+        num_cpus=args.num_cpus,
+        use_process_pool=mode == "pool",
+        cache_size=args.cache_size,
+    )
+    config.post_init()
+    tokenizer = get_tokenizer(args.tokenizer)
+    data = make_data(make_corpus(reward, args), tokenizer)
+    reward_manager: FunctionRewardManager
+    if reward_type == "sequential":
+        reward_manager = SequentialFunctionRewardManager(config, tokenizer)
+    else:
+        reward_manager = BatchFunctionRewardManager(config, tokenizer)
+
+    if mode == "pool":  # warm up the workers
+        reward_manager._compute_scores(reward_manager._get_reward_inputs(data[: args.num_cpus]))
+
+    call_latencies, sample_latencies = [], []
+    start_time = time.perf_counter()
+    for i in range(0, len(data), args.batch_size):
+        batch = data[i : i + args.batch_size]
+        call_start_time = time.perf_counter()
+        reward_manager.compute_reward(batch)
+        call_latencies.append(time.perf_counter() - call_start_time)
+        sample_latencies.append(call_latencies[-1] / len(batch))
+
+    total_time = time.perf_counter() - start_time
+    peak_rss = (
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss + resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    )
+    return {
+        "reward": reward,
+        "mode": mode,
+        "samples": len(data),
+        "samples_per_sec": len(data) / total_time,
+        "samples_per_call": args.batch_size,
+        "call_p50_ms": float(np.percentile(call_latencies, 50)) * 1000,
+        "call_p99_ms": float(np.percentile(call_latencies, 99)) * 1000,
+        "sample_p50_ms": float(np.percentile(sample_latencies, 50)) * 1000,
+        "sample_p99_ms": float(np.percentile(sample_latencies, 99)) * 1000,
+        "peak_rss_mb": peak_rss / 1024,
+    }
+
+
+def run_isolated(reward: str, mode: str, args: argparse.Namespace) -> Optional[dict[str, Any]]:
+    """Run each benchmark in a fresh process so that the peak RSS is not shared."""
+    reward_type = REWARD_FUNCTIONS[reward][1]
+    if (reward_type == "sequential") != (mode == "sequential"):  # the manager is decided by the reward type
+        return None
+
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as pool:
+        return pool.submit(run_benchmark, reward, mode, args).result()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--reward", nargs="+", default=list(REWARD_FUNCTIONS.keys()), choices=REWARD_FUNCTIONS.keys())
+    parser.add_argument("--mode", nargs="+", default=["sequential", "batch"], choices=["sequential", "batch", "pool"])
+    parser.add_argument("--tokenizer", default="Qwen/Qwen2.5-VL-7B-Instruct", type=str, help="Tokenizer path")
+    parser.add_argument("--num_samples", default=2048, type=int, help="Number of responses in the corpus")
+    parser.add_argument("--group_size", default=8, type=int, help="Responses per ground truth, i.e., rollout.n")
+    parser.add_argument("--batch_size", default=512, type=int, help="Responses per call of compute_reward")
+    parser.add_argument("--num_cpus", default=4, type=int, help="Process pool size in pool mode")
+    parser.add_argument("--cache_size", default=0, type=int, help="Size of the score cache of the reward manager")
+    parser.add_argument("--min_length", default=64, type=int, help="Min number of words before the answer")
+    parser.add_argument("--max_length", default=1024, type=int, help="Max number of words before the answer")
+    parser.add_argument("--valid_rate", default=0.9, type=float, help="Fraction of well-formatted answers")
+    parser.add_argument("--correct_rate", default=0.3, type=float, help="Fraction of answers equal to ground truth")
+    parser.add_argument("--duplicate_rate", default=0.1, type=float, help="Fraction of repeated responses in a group")
+    parser.add_argument("--min_nodes", default=2, type=int, help="Min number of graph nodes for dapo_graph")
+    parser.add_argument("--max_nodes", default=8, type=int, help="Max number of graph nodes for dapo_graph")
+    parser.add_argument("--min_edges", default=1, type=int, help="Min number of graph edges for dapo_graph")
+    parser.add_argument("--max_edges", default=8, type=int, help="Max number of graph edges for dapo_graph")
+    parser.add_argument("--seed", default=1, type=int)
+    parser.add_argument("--output", default=None, type=str, help="Save the results to a json file")
+    args = parser.parse_args()
+
+    results = []
+    header = (
+        f"{'reward':<12}{'mode':<12}{'samples':>9}{'samples/s':>12}{'samples/call':>14}"
+        f"{'call p50 ms':>13}{'call p99 ms':>13}{'sample p50 ms':>15}{'sample p99 ms':>15}{'peak RSS MB':>13}"
+    )
+    print(header)
+    print("-" * len(header))
+    for reward in args.reward:
+        for mode in args.mode:
+            result = run_isolated(reward, mode, args)
+            if result is None:
+                continue
+
+            results.append(result)
+            print(
+                f"{result['reward']:<12}{result['mode']:<12}{result['samples']:>9}{result['samples_per_sec']:>12.1f}"
+                f"{result['samples_per_call']:>14}{result['call_p50_ms']:>13.3f}{result['call_p99_ms']:>13.3f}"
+                f"{result['sample_p50_ms']:>15.3f}{result['sample_p99_ms']:>15.3f}{result['peak_rss_mb']:>13.1f}"
+            )
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
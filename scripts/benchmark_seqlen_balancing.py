@@ -0,0 +1,138 @@
+# Copyright 2024 Bytedance Ltd. and/or its affiliates
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Benchmark the Karmarkar-Karp partitioner against the previous object-based implementation.
+
+Example:
+    python scripts/benchmark_seqlen_balancing.py --num_items 4096 16384 65536 --k_partitions 8 64 256
+"""
+
+import argparse
+import heapq
+import os
+import sys
+import time
+from typing import Tuple
+
+import numpy as np
+
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from verl.utils.seqlen_balancing import karmarkar_karp  # noqa: E402
+
+
+class Set:
+    def __init__(self) -> None:
+        self.sum = 0
+        self.items = []
+
+    def add(self, idx: int, val: int):
+        self.items.append((idx, val))
+        self.sum += val
+
+    def merge(self, other):
+        for idx, val in other.items:
+            self.items.append((idx, val))
+            self.sum += val
+
+    def __lt__(self, other):
+        if self.sum != other.sum:
+            return self.sum < other.sum
+        if len(self.items) != len(other.items):
+            return len(self.items) < len(other.items)
+        return self.items < other.items
+
+
+class State:
+    def __init__(self, items: list[Tuple[int, int]], k: int) -> None:
+        self.k = k
+        self.sets = [Set() for _ in range(k)]
+        for i, (idx, seqlen) in enumerate(items):
+            self.sets[i].add(idx=idx, val=seqlen)
+        self.sets = sorted(self.sets, reverse=True)
+
+    def merge(self, other):
+        for i in range(self.k):
+            self.sets[i].merge(other.sets[self.k - 1 - i])
+        self.sets = sorted(self.sets, reverse=True)
+
+    @property
+    def spread(self) -> int:
+        return self.sets[0].sum - self.sets[-1].sum
+
+    def __lt__(self, other):
+        if self.spread != other.spread:
+            return self.spread > other.spread
+        return self.sets[0] > other.sets[0]
+
+
+def reference_karmarkar_karp(seqlen_list: list[int], k_partitions: int, equal_size: bool):
+    """The previous implementation, which copies the items of every set on each merge."""
+    sorted_seqlen_list = sorted([(seqlen, i) for i, seqlen in enumerate(seqlen_list)])
+    states_pq: list[State] = []
+    if equal_size:
+        for offset in range(0, len(sorted_seqlen_list), k_partitions):
+            items = [(idx, seqlen) for seqlen, idx in sorted_seqlen_list[offset : offset + k_partitions]]
+            heapq.heappush(states_pq, State(items=items, k=k_partitions))
+    else:
+        for seqlen, idx in sorted_seqlen_list:
+            heapq.heappush(states_pq, State(items=[(idx, seqlen)], k=k_partitions))
+
+    while len(states_pq) > 1:
+        state0 = heapq.heappop(states_pq)
+        state1 = heapq.heappop(states_pq)
+        state0.merge(state1)
+        heapq.heappush(states_pq, state0)
+
+    return [[idx for idx, _ in partition.items] for partition in states_pq[0].sets]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--num_items", nargs="+", default=[4096, 16384, 65536], type=int)
+    parser.add_argument("--k_partitions", nargs="+", default=[8, 64, 256], type=int)
+    parser.add_argument("--max_seqlen", default=8192, type=int, help="Max sequence length of the items")
+    parser.add_argument("--equal_size", action="store_true", help="Partitions have the same number of items")
+    parser.add_argument("--skip_reference", action="store_true", help="Only time the current implementation")
+    parser.add_argument("--seed", default=1, type=int)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    header = f"{'items':>8}{'partitions':>12}{'reference s':>14}{'current s':>12}{'speedup':>10}{'spread':>10}"
+    print(header)
+    print("-" * len(header))
+    for num_items in args.num_items:
+        seqlen_list = rng.integers(1, args.max_seqlen + 1, size=num_items).tolist()
+        for k_partitions in args.k_partitions:
+            start_time = time.perf_counter()
+            partitions = karmarkar_karp(seqlen_list, k_partitions, args.equal_size)
+            current_time = time.perf_counter() - start_time
+            sums = [sum(seqlen_list[idx] for idx in partition) for partition in partitions]
+            if args.skip_reference:
+                reference_time = float("nan")
+            else:
+                start_time = time.perf_counter()
+                reference_partitions = reference_karmarkar_karp(seqlen_list, k_partitions, args.equal_size)
+                reference_time = time.perf_counter() - start_time
+                assert partitions == reference_partitions, "Partitions differ from the reference implementation."
+
+            print(
+                f"{num_items:>8}{k_partitions:>12}{reference_time:>14.3f}{current_time:>12.3f}"
+                f"{reference_time / current_time:>10.1f}{max(sums) - min(sums):>10}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+# Copyright 2024 Bytedance Ltd. and/or its affiliates
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numpy as np
+import torch
+
+from verl.trainer.core_algos import (
+    compute_gae_advantage_return,
+    compute_grpo_outcome_advantage,
+    compute_reinforce_plus_plus_outcome_advantage,
+    compute_rloo_outcome_advantage,
+)
+from verl.utils import torch_functional as VF
+
+
+def _make_outcome_batch(batch_size: int = 64, response_length: int = 16, n: int = 4):
+    torch.manual_seed(1)
+    response_mask = torch.zeros(batch_size, response_length)
+    response_lengths = torch.randint(1, response_length + 1, (batch_size,))
+    for i, length in enumerate(response_lengths):
+        response_mask[i, :length] = 1
+
+    token_level_rewards = torch.zeros(batch_size, response_length)
+    token_level_rewards[torch.arange(batch_size), response_lengths - 1] = torch.randn(batch_size)
+    index = np.array([f"uid-{i}" for i in np.random.default_rng(1).permutation(batch_size // n)]).repeat(n)
+    return token_level_rewards, response_mask, index
+
+
+def test_grpo_advantage():
+    token_level_rewards, response_mask, index = _make_outcome_batch()
+    advantages, _ = compute_grpo_outcome_advantage(token_level_rewards, response_mask, index)
+    scores = token_level_rewards.sum(dim=-1)
+    expected = torch.zeros_like(scores)
+    for uid in np.unique(index):
+        group = torch.as_tensor(index == uid)
+        expected[group] = (scores[group] - scores[group].mean()) / (scores[group].std() + 1e-6)
+
+    torch.testing.assert_close(advantages, expected.unsqueeze(-1) * response_mask)
+
+
+def test_rloo_advantage():
+    token_level_rewards, response_mask, index = _make_outcome_batch()
+    advantages, _ = compute_rloo_outcome_advantage(token_level_rewards, response_mask, index)
+    scores = token_level_rewards.sum(dim=-1)
+    expected = torch.zeros_like(scores)
+    for uid in np.unique(index):
+        group = torch.as_tensor(index == uid)
+        expected[group] = scores[group] - (scores[group].sum() - scores[group]) / (group.sum() - 1)
+
+    torch.testing.assert_close(advantages, expected.unsqueeze(-1) * response_mask)
+
+
+def test_gae_advantage():
+    token_level_rewards, response_mask, _ = _make_outcome_batch(response_length=300)
+    values = torch.randn_like(token_level_rewards) * response_mask
+    gamma, lam = 0.99, 0.95
+    advantages, returns = compute_gae_advantage_return(token_level_rewards, values, response_mask, gamma, lam)
+    lastgaelam, advantages_reversed = 0, []
+    for t in reversed(range(token_level_rewards.size(1))):
+        nextvalues = values[:, t + 1] if t < token_level_rewards.size(1) - 1 else 0.0
+        lastgaelam = token_level_rewards[:, t] + gamma * nextvalues - values[:, t] + gamma * lam * lastgaelam
+        advantages_reversed.append(lastgaelam)
+
+    expected = torch.stack(advantages_reversed[::-1], dim=1)
+    torch.testing.assert_close(returns, expected + values, atol=1e-5, rtol=1e-5)
+    torch.testing.assert_close(advantages, VF.masked_whiten(expected, response_mask), atol=1e-5, rtol=1e-5)
+
+
+def test_reinforce_plus_plus_advantage():
+    token_level_rewards, response_mask, _ = _make_outcome_batch(response_length=300)
+    response_mask[::3, 5] = 0  # resets in the middle of a response
+    token_level_rewards = token_level_rewards + torch.randn_like(token_level_rewards) * 0.1
+    for gamma in (1.0, 0.9):
+        _, returns = compute_reinforce_plus_plus_outcome_advantage(token_level_rewards, response_mask, gamma)
+        expected, running_return = torch.zeros_like(token_level_rewards), 0
+        for t in reversed(range(token_level_rewards.size(1))):
+            running_return = token_level_rewards[:, t] + gamma * running_return
+            expected[:, t] = running_return
+            running_return = running_return * response_mask[:, t]
+
+        torch.testing.assert_close(returns, expected, atol=1e-5, rtol=1e-5)
@@ -14,13 +14,18 @@
 
 
 import os
+import pickle
+from types import SimpleNamespace
 from typing import Any, Optional
 
 import numpy as np
 import pytest
 import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
 
-from verl.protocol import DataProto, pad_dataproto_to_divisor, unpad_dataproto
+from verl.protocol import DataProto, allgather_dict_tensors, pad_dataproto_to_divisor, unpad_dataproto
+from verl.single_controller.base.decorator import dispatch_dp_compute_data_proto, select_keys_before_dispatch
 
 
 def _get_data_proto(
@@ -171,6 +176,76 @@ def test_data_proto_save_load():
     _assert_equal(data, loaded_data)
 
 
+@pytest.mark.parametrize("mmap", [False, True])
+def test_data_proto_save_load_directory(tmp_path, mmap: bool):
+    tensors = {"obs": torch.randn(6, 4).bfloat16(), "mask": torch.ones(6, 2, dtype=torch.bool)}
+    data = _get_data_proto(tensors=tensors, meta_info={"temperature": 1.0, "shape": (6, 4)})
+    data.non_tensor_batch["index"] = np.arange(6)
+    data.save_to_disk(str(tmp_path / "data"), as_directory=True)
+    loaded_data = DataProto.load_from_disk(str(tmp_path / "data"), mmap=mmap)
+    assert loaded_data.batch["obs"].dtype == torch.bfloat16
+    assert isinstance(loaded_data.non_tensor_batch["index"], np.memmap) == mmap
+    assert loaded_data.meta_info == data.meta_info
+    _assert_equal(data, loaded_data)
+
+
+def test_data_proto_pickle_out_of_band():
+    tensors = {"obs": torch.randn(6, 4).bfloat16(), "mask": torch.ones(6, 3, dtype=torch.bool)[:, :2]}
+    data = _get_data_proto(tensors=tensors, non_tensors={"labels": ["a", "b", "c", "d", "e", "f"]})
+    buffers = []
+    payload = pickle.dumps(data, protocol=5, buffer_callback=buffers.append)
+    assert len(buffers) == len(tensors)  # tensors are not copied into the payload
+    loaded_data = pickle.loads(payload, buffers=buffers)
+    assert loaded_data.batch["obs"].dtype == torch.bfloat16
+    _assert_equal(data, loaded_data)
+
+
+def test_data_proto_pickle_read_only_buffers():
+    tensors = {"obs": torch.randn(4, 3), "empty": torch.randn(4, 0)}
+    data = _get_data_proto(tensors=tensors, non_tensors={"labels": ["a", "b", "c", "d"]})
+    buffers = []
+    payload = pickle.dumps(data, protocol=5, buffer_callback=buffers.append)
+    read_only_buffers = [memoryview(buffer.raw()).toreadonly() for buffer in buffers]  # as in the ray object store
+    loaded_data = pickle.loads(payload, buffers=read_only_buffers)
+    assert loaded_data.batch["empty"].shape == (4, 0)
+    _assert_equal(data, loaded_data)
+
+
+def test_select_keys_before_dispatch():
+    tensors = {"obs": torch.randn(6, 4), "act": torch.randn(6, 2)}
+    data = _get_data_proto(tensors=tensors, non_tensors={"labels": ["a", "b", "c", "d", "e", "f"]})
+    dispatch_fn = select_keys_before_dispatch(dispatch_dp_compute_data_proto, ["obs", "missing"], [])
+    (splitted_data,), _ = dispatch_fn(SimpleNamespace(world_size=2), data)
+    assert len(splitted_data) == 2
+    for chunk in splitted_data:
+        assert list(chunk.batch.keys()) == ["obs"]
+        assert len(chunk.non_tensor_batch) == 0
+        assert chunk.meta_info == data.meta_info
+
+    assert torch.all(torch.cat([chunk.batch["obs"] for chunk in splitted_data]) == tensors["obs"])
+
+
+def _allgather_dict_tensors_worker(rank: int, size: int, init_file: str):
+    dist.init_process_group("gloo", init_method=f"file://{init_file}", rank=rank, world_size=size)
+    tensors = {
+        "obs": torch.arange(6).view(3, 2) + 10 * rank,
+        "mask": torch.ones(3, 4, dtype=torch.bool)[:, ::2],
+        "act": torch.full((3,), rank, dtype=torch.bfloat16),
+    }
+    output = allgather_dict_tensors(tensors, size=size, group=None, dim=0)
+    assert list(output.keys()) == list(tensors.keys())
+    for key, value in tensors.items():
+        expected = [torch.empty_like(value.contiguous()) for _ in range(size)]
+        dist.all_gather(expected, value.contiguous())
+        assert torch.equal(output[key], torch.cat(expected, dim=0))
+
+    dist.destroy_process_group()
+
+
+def test_allgather_dict_tensors(tmp_path):
+    mp.spawn(_allgather_dict_tensors_worker, args=(2, str(tmp_path / "init")), nprocs=2)
+
+
 def test_union_tensor_dict():
     obs = torch.randn(100, 10)
     data1 = _get_data_proto({"obs": obs, "act": torch.randn(100, 3)})
@@ -12,10 +12,16 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from io import BytesIO
+
+import numpy as np
 import torch
+from datasets import Image as ImageFeature
+from PIL import Image as PILImage
 from PIL.Image import Image
 
-from verl.utils.dataset import RLHFDataset
+from verl.utils.dataset import RLHFDataset, get_image_size, process_image
+from verl.utils.image_cache import ImageCache
 from verl.utils.tokenizer import get_processor, get_tokenizer
 
 
@@ -51,5 +57,116 @@ def test_image_dataset():
     assert isinstance(dataset[0]["multi_modal_data"]["images"][0], Image)
 
 
+def test_image_dataset_preprocess_cache(tmp_path):
+    tokenizer = get_tokenizer("Qwen/Qwen2.5-VL-7B-Instruct", use_fast=True)
+    processor = get_processor("Qwen/Qwen2.5-VL-7B-Instruct", use_fast=True)
+    kwargs = {
+        "data_path": "hiyouga/geometry3k@test",
+        "tokenizer": tokenizer,
+        "processor": processor,
+        "prompt_key": "problem",
+        "answer_key": "answer",
+        "image_key": "images",
+        "max_prompt_length": 16,
+        "truncation": "right",
+        "filter_overlong_prompts": False,
+        "return_multi_modal_inputs": True,
+    }
+    dataset = RLHFDataset(**kwargs)
+    cached_dataset = RLHFDataset(preprocess_cache_dir=str(tmp_path), **kwargs)
+    assert len(cached_dataset) == len(dataset)
+    assert cached_dataset[0].keys() == dataset[0].keys()
+    for key in ("input_ids", "attention_mask", "position_ids"):
+        assert torch.all(cached_dataset[0][key] == dataset[0][key])
+
+    assert cached_dataset[0]["raw_prompt_ids"] == dataset[0]["raw_prompt_ids"]
+    multi_modal_inputs = dataset[0]["multi_modal_inputs"]
+    assert multi_modal_inputs.keys() == {"pixel_values", "image_grid_thw"}
+    for key, value in cached_dataset[0]["multi_modal_inputs"].items():
+        assert torch.equal(value, multi_modal_inputs[key])
+
+
+def test_estimate_prompt_length():
+    tokenizer = get_tokenizer("Qwen/Qwen2.5-VL-7B-Instruct", use_fast=True)
+    processor = get_processor("Qwen/Qwen2.5-VL-7B-Instruct", use_fast=True)
+    kwargs = {
+        "data_path": "hiyouga/geometry3k@test",
+        "tokenizer": tokenizer,
+        "processor": processor,
+        "prompt_key": "problem",
+        "answer_key": "answer",
+        "image_key": "images",
+        "min_pixels": 262144,
+        "max_pixels": 4194304,
+    }
+    prompt_lengths = RLHFDataset(max_prompt_length=1 << 20, **kwargs).dataset["prompt_length"]
+    max_prompt_length = sorted(prompt_lengths)[len(prompt_lengths) // 2]  # the filter boundary
+    dataset = RLHFDataset(max_prompt_length=max_prompt_length, estimate_prompt_length=False, **kwargs)
+    estimated_dataset = RLHFDataset(max_prompt_length=max_prompt_length, estimate_prompt_length=True, **kwargs)
+    assert 0 < len(estimated_dataset) < len(prompt_lengths)
+    assert estimated_dataset.dataset["prompt_length"] == dataset.dataset["prompt_length"]
+    assert estimated_dataset.dataset["answer"] == dataset.dataset["answer"]
+    assert max(estimated_dataset.dataset["prompt_length"]) == max_prompt_length
+
+
+def test_get_image_size_exif_orientation():
+    for orientation, size in ((1, (200, 100)), (3, (200, 100)), (6, (100, 200)), (8, (100, 200))):
+        exif = PILImage.Exif()
+        exif[0x0112] = orientation
+        buffer = BytesIO()
+        PILImage.new("RGB", (200, 100)).save(buffer, format="JPEG", exif=exif)
+        image = {"bytes": buffer.getvalue(), "path": None}
+        assert get_image_size(image) == size
+        assert get_image_size(image) == process_image(image, None, None).size
+
+
+def test_process_image_cache(tmp_path):
+    image_cache = ImageCache(str(tmp_path / "image_cache"), max_size_gb=1e-4)  # about 100 KiB
+    images = []
+    for i in range(4):
+        buffer = BytesIO()
+        PILImage.fromarray(np.full((128, 256, 3), i * 60, dtype=np.uint8)).save(buffer, format="PNG")
+        images.append({"bytes": buffer.getvalue()})
+
+    expected = np.asarray(process_image(images[0], 4096, 8192))
+    assert np.array_equal(np.asarray(process_image(images[0], 4096, 8192, image_cache)), expected)  # miss
+    assert len(list((tmp_path / "image_cache").iterdir())) == 1
+    assert np.array_equal(np.asarray(process_image(images[0], 4096, 8192, image_cache)), expected)  # hit
+    process_image(images[0], 1024, 2048, image_cache)  # resize arguments are part of the key
+    assert len(list((tmp_path / "image_cache").iterdir())) == 2
+
+    decoded_image = PILImage.open(BytesIO(images[0]["bytes"]))  # decoded by datasets, keyed by the pixels
+    key = ImageCache.get_key(decoded_image, 4096, 8192)
+    assert image_cache.get(key) is None
+    assert np.array_equal(np.asarray(process_image(decoded_image, 4096, 8192, image_cache)), expected)  # miss
+    assert image_cache.get(key) is not None
+    assert len(list((tmp_path / "image_cache").iterdir())) == 3
+    assert np.array_equal(np.asarray(process_image(decoded_image, 4096, 8192, image_cache)), expected)  # hit
+    assert len(list((tmp_path / "image_cache").iterdir())) == 3
+
+    for image in images[1:]:
+        process_image(image, None, None, image_cache)  # 96 KiB each
+
+    image_cache.evict()
+    assert sum(path.stat().st_size for path in (tmp_path / "image_cache").iterdir()) <= image_cache.max_size
+
+
+def test_process_image_exif_orientation(tmp_path):
+    exif = PILImage.Exif()
+    exif[0x0112] = 6  # rotated by 90 degrees, displayed as 100x200
+    buffer = BytesIO()
+    pixels = np.random.default_rng(0).integers(0, 255, (100, 200, 3), dtype=np.uint8)
+    PILImage.fromarray(pixels).save(buffer, format="JPEG", exif=exif)
+    image = {"bytes": buffer.getvalue(), "path": None}
+
+    decoded_image = ImageFeature().decode_example(image)  # decoded by datasets
+    expected = np.asarray(process_image(decoded_image, None, None))
+    assert expected.shape == (200, 100, 3)
+    image_cache = ImageCache(str(tmp_path / "image_cache"))
+    assert np.array_equal(np.asarray(process_image(image, None, None)), expected)
+    assert np.array_equal(np.asarray(process_image(image, None, None, image_cache)), expected)  # miss
+    assert np.array_equal(np.asarray(process_image(image, None, None, image_cache)), expected)  # hit
+
+
 if __name__ == "__main__":
     test_image_dataset()
@@ -14,9 +14,17 @@
 
 import numpy as np
 import torch
+from tensordict import TensorDict
 
 from verl.protocol import DataProto
-from verl.utils.seqlen_balancing import prepare_dynamic_batch, restore_dynamic_batch
+from verl.utils.seqlen_balancing import (
+    get_seqlen_balanced_partitions,
+    get_seqlen_costs,
+    karmarkar_karp,
+    prepare_dynamic_batch,
+    rearrange_micro_batches,
+    restore_dynamic_batch,
+)
 
 
 def _create_random_mask(
@@ -72,7 +80,53 @@ def test_dynamic_batch():
     )
     data = {"input_ids": input_ids, "attention_mask": attention_mask}
     dataproto = DataProto.from_single_dict(data)
-    micro_batches, micro_bsz_idx_lst = prepare_dynamic_batch(dataproto, max_token_len=300)
-    input_ids = torch.cat([micro_batch.batch["input_ids"] for micro_batch in micro_batches], dim=0)
-    input_ids = restore_dynamic_batch(input_ids, micro_bsz_idx_lst)
-    torch.testing.assert_close(input_ids, dataproto.batch["input_ids"])
+    for balance_cost in ("linear", "quadratic", "flops"):
+        micro_batches, micro_bsz_idx_lst = prepare_dynamic_batch(
+            dataproto, max_token_len=300, balance_cost=balance_cost, attention_cost_ratio=0.01
+        )
+        input_ids = torch.cat([micro_batch.batch["input_ids"] for micro_batch in micro_batches], dim=0)
+        input_ids = restore_dynamic_batch(input_ids, micro_bsz_idx_lst)
+        torch.testing.assert_close(input_ids, dataproto.batch["input_ids"])
+
+
+def test_dynamic_batch_max_token_len():
+    # a few long and many short sequences, balancing the quadratic cost groups the short ones together
+    seqlen_list = [945, 49, 995, 900, 989, 38, 100, 61, 998, 921, 933, 77, 1016, 14]
+    attention_mask = torch.zeros(len(seqlen_list), 1024, dtype=torch.int64)
+    for i, seqlen in enumerate(seqlen_list):
+        attention_mask[i, :seqlen] = 1
+
+    dataproto = DataProto.from_single_dict({"attention_mask": attention_mask})
+    for balance_cost in ("linear", "quadratic", "flops"):
+        micro_batches, _ = prepare_dynamic_batch(
+            dataproto, max_token_len=2048, balance_cost=balance_cost, attention_cost_ratio=0.01
+        )
+        assert sum(len(micro_batch) for micro_batch in micro_batches) == len(seqlen_list)
+        for micro_batch in micro_batches:
+            assert micro_batch.batch["attention_mask"].sum() <= 2048
+
+
+def test_dynamic_batch_linear_cost():
+    # the linear cost keeps the token-balanced partitions if none of them exceeds max_token_len
+    seqlen_list = [512, 100, 384, 256, 64, 448, 320, 192, 128, 500, 30, 260]
+    attention_mask = torch.zeros(len(seqlen_list), 512, dtype=torch.int64)
+    for i, seqlen in enumerate(seqlen_list):
+        attention_mask[i, :seqlen] = 1
+
+    batch = TensorDict({"attention_mask": attention_mask}, batch_size=[len(seqlen_list)])
+    _, micro_bsz_idx = rearrange_micro_batches(batch, max_token_len=1024)
+    expected = get_seqlen_balanced_partitions(seqlen_list, 4, equal_size=False)  # ceil(3194 / 1024) micro batches
+    assert sorted(map(sorted, micro_bsz_idx)) == sorted(map(sorted, expected))
+    assert [sum(seqlen_list[idx] for idx in partition) for partition in micro_bsz_idx] == [832, 804, 786, 772]
+
+
+def test_seqlen_costs():
+    assert get_seqlen_costs([10, 200], "linear") == [10, 200]
+    assert get_seqlen_costs([10, 200], "quadratic") == [100, 40000]
+    assert get_seqlen_costs([10, 200], "flops", attention_cost_ratio=0.01) == [11, 600]
+
+
+def test_karmarkar_karp():
+    seqlen_list = [5, 1, 9, 3, 3, 7, 2, 8, 6, 4, 4, 1]
+    assert karmarkar_karp(seqlen_list, 3, equal_size=False) == [[9, 1, 2, 10], [6, 3, 5, 8], [4, 11, 7, 0]]
+    assert karmarkar_karp(seqlen_list, 3, equal_size=True) == [[9, 1, 2, 10], [3, 6, 5, 8], [4, 11, 7, 0]]
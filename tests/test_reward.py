@@ -0,0 +1,130 @@
+# Copyright 2024 Bytedance Ltd. and/or its affiliates
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numpy as np
+import torch
+
+from verl.protocol import DataProto
+from verl.workers.reward.config import RewardConfig
+from verl.workers.reward.function import BatchFunctionRewardManager, SequentialFunctionRewardManager
+
+
+REWARD_FUNCTION = """
+def compute_score(reward_inputs, bonus=0.0):
+    return [compute_score_single(reward_input, bonus) for reward_input in reward_inputs]
+
+
+def compute_score_single(reward_input, bonus=0.0):
+    accuracy = float(reward_input["response"] == reward_input["ground_truth"])
+    return {"overall": accuracy + 0.1 * reward_input["response_length"] + bonus, "accuracy": accuracy}
+"""
+
+
+class CharTokenizer:
+    """Maps each token id to a character, enough for decoding the responses in the reward managers."""
+
+    def batch_decode(self, sequences: list[list[int]], skip_special_tokens: bool = True) -> list[str]:
+        return ["".join(chr(token_id) for token_id in token_ids) for token_ids in sequences]
+
+
+def _make_config(tmp_path, reward_type: str = "batch", **kwargs) -> RewardConfig:
+    reward_function = tmp_path / "reward_function.py"
+    reward_function.write_text(REWARD_FUNCTION)
+    function_name = "compute_score" if reward_type == "batch" else "compute_score_single"
+    config = RewardConfig(reward_type=reward_type, reward_function=f"{reward_function}:{function_name}", **kwargs)
+    config.post_init()
+    return config
+
+
+def _make_data(responses: list[str], ground_truths: list[str], response_length: int = 8) -> DataProto:
+    response_ids = torch.zeros((len(responses), response_length), dtype=torch.long)
+    response_mask = torch.zeros((len(responses), response_length), dtype=torch.long)
+    for i, response in enumerate(responses):
+        response_ids[i, : len(response)] = torch.tensor([ord(char) for char in response], dtype=torch.long)
+        response_mask[i, : len(response)] = 1
+
+    return DataProto.from_single_dict(
+        {
+            "responses": response_ids,
+            "response_mask": response_mask,
+            "ground_truth": np.array(ground_truths, dtype=object),
+        }
+    )
+
+
+def test_reward_tensor(tmp_path):
+    reward_manager = SequentialFunctionRewardManager(_make_config(tmp_path, "sequential"), CharTokenizer())
+    data = _make_data(["abc", "", "abcdefgh"], ["abc", "x", "y"])
+    reward_tensor, reward_metrics = reward_manager.compute_reward(data)
+    expected = torch.zeros(3, 8)
+    expected[0, 2] = 1.3  # the last valid token
+    expected[2, 7] = 0.8  # the response fills the whole tensor
+    expected[1, 0] = 0.0  # the empty response gets its score on the first (masked) token
+    torch.testing.assert_close(reward_tensor, expected)
+    assert reward_metrics["accuracy"] == [1.0, 0.0, 0.0]
+    assert "cache_hit" not in reward_metrics
+
+    data = _make_data(["", ""], ["", "x"])
+    reward_tensor, _ = reward_manager.compute_reward(data)
+    torch.testing.assert_close(reward_tensor, torch.tensor([[1.0] + [0.0] * 7, [0.0] * 8]))
+
+
+def test_reward_cache(tmp_path):
+    reward_manager = BatchFunctionRewardManager(_make_config(tmp_path, cache_size=2), CharTokenizer())
+    _, reward_metrics = reward_manager.compute_reward(_make_data(["a", "b", "a"], ["a", "a", "a"]))
+    assert reward_metrics["cache_hit"] == [0.0, 0.0, 0.0]  # duplicates in a batch are scored once
+    assert len(reward_manager.cache) == 2
+
+    # hit on "a" moves it to the end, so "b" is evicted by "c"
+    _, reward_metrics = reward_manager.compute_reward(_make_data(["a", "c"], ["a", "a"]))
+    assert reward_metrics["cache_hit"] == [1.0, 0.0]
+    reward_tensor, reward_metrics = reward_manager.compute_reward(_make_data(["c", "a", "b"], ["a", "a", "a"]))
+    assert reward_metrics["cache_hit"] == [1.0, 1.0, 0.0]
+    assert reward_metrics["accuracy"] == [0.0, 1.0, 0.0]
+    torch.testing.assert_close(reward_tensor[:, 0], torch.tensor([0.1, 1.1, 0.1]))
+
+    # the ground truth is part of the key
+    _, reward_metrics = reward_manager.compute_reward(_make_data(["b"], ["b"]))
+    assert reward_metrics["cache_hit"] == [0.0] and reward_metrics["accuracy"] == [1.0]
+
+
+def test_reward_cache_key(tmp_path):
+    reward_input = {"response": "abc", "response_length": 3, "ground_truth": "abc"}
+    config = _make_config(tmp_path, cache_size=2, reward_function_kwargs={"bonus": 0.5})
+    key = BatchFunctionRewardManager(config, CharTokenizer())._get_cache_key(reward_input)
+    config = _make_config(tmp_path, cache_size=2, reward_function_kwargs={"bonus": 1.0})
+    assert BatchFunctionRewardManager(config, CharTokenizer())._get_cache_key(reward_input) != key
+    config = _make_config(tmp_path, cache_size=2, reward_function_kwargs={"bonus": 0.5})
+    assert BatchFunctionRewardManager(config, CharTokenizer())._get_cache_key(reward_input) == key
+    assert (
+        BatchFunctionRewardManager(config, CharTokenizer())._get_cache_key({**reward_input, "response_length": 4})
+        != key
+    )
+
+
+def test_reward_process_pool(tmp_path):
+    responses = ["abc", "", "ab", "abcdefgh", "b", "abc", "x"]
+    data = _make_data(responses, ["abc", "x", "ab", "y", "b", "z", "x"])
+    reward_manager = BatchFunctionRewardManager(_make_config(tmp_path, num_cpus=3), CharTokenizer())
+    expected_tensor, expected_metrics = reward_manager.compute_reward(data)
+    config = _make_config(tmp_path, num_cpus=3, use_process_pool=True)
+    pool_reward_manager = BatchFunctionRewardManager(config, CharTokenizer())
+    assert pool_reward_manager.pool is not None
+    try:
+        reward_tensor, reward_metrics = pool_reward_manager.compute_reward(data)
+    finally:
+        pool_reward_manager.pool.shutdown()
+
+    assert torch.equal(reward_tensor, expected_tensor)
+    assert reward_metrics == expected_metrics
@@ -0,0 +1,52 @@
+# Copyright 2024 Bytedance Ltd. and/or its affiliates
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import importlib.util
+import os
+
+
+def _load_dapo_graph():
+    path = os.path.join(os.path.dirname(__file__), "..", "examples", "reward_function", "dapo_graph.py")
+    spec = importlib.util.spec_from_file_location("dapo_graph", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+dapo_graph = _load_dapo_graph()
+
+
+def test_scan_answer_json():
+    answer = '{"nodes": [{"name": "a {b", "edges": {"x": [1, {"y": 2}]}}], "text": "} \\" ]"}'
+    response = f"Answer: {{draft}}\nsome thoughts\nAnswer: {answer} trailing {{braces}}"
+    span, answer_json = dapo_graph.scan_answer_json(response)
+    assert response[span[0] : span[1]] == answer
+    assert answer_json["nodes"][0]["edges"]["x"][1] == {"y": 2}
+    assert dapo_graph.extract_answer_json(response) == answer_json
+
+    # the last marker is used even if the previous ones are valid
+    span, answer_json = dapo_graph.scan_answer_json('Answer: {"a": 1} Answer : {"b": {"c": 2}}')
+    assert span == (26, 41) and answer_json == {"b": {"c": 2}}
+
+    # markers without an object are skipped
+    assert dapo_graph.scan_answer_json('Answer: {"a": 1}\nAnswer: none') == ((8, 16), {"a": 1})
+
+
+def test_scan_answer_json_invalid():
+    assert dapo_graph.scan_answer_json("no answer here") == (None, None)
+    assert dapo_graph.scan_answer_json('Answer: {"a": {"b": 1}') == (None, None)  # truncated
+    assert dapo_graph.scan_answer_json('Answer: {"a": "}"') == (None, None)  # unterminated string
+    assert dapo_graph.scan_answer_json("Answer: {a: 1}") == (None, None)  # not json
+    deep = "Answer: " + "{" * 64 + "}" * 64
+    assert dapo_graph.scan_answer_json(deep) == (None, None)  # too deep
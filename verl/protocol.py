@@ -18,6 +18,8 @@ We can subclass Protocol to define more detailed batch info with specific keys
 
 import copy
 import io
+import json
+import os
 import pickle
 from collections import defaultdict
 from dataclasses import dataclass, field
@@ -44,6 +46,9 @@ except Exception:
 
 __all__ = ["DataProto", "union_tensor_dict"]
 
+DATA_PROTO_DIR_VERSION = 1
+DATA_PROTO_MANIFEST = "manifest.json"
+
 
 def pad_dataproto_to_divisor(data: "DataProto", size_divisor: int) -> tuple["DataProto", int]:
     """Pad a DataProto to size divisible by size_divisor
@@ -203,35 +208,145 @@ class DataProto:
 
         raise TypeError(f"Indexing with {type(item)} is not supported.")
 
-    def __getstate__(self) -> tuple[bytes, dict[str, NDArray], dict[str, Any]]:
+    def __getstate__(self) -> tuple[Optional[dict[str, Any]], dict[str, NDArray], dict[str, Any]]:
+        """
+        Expose each tensor as a uint8 numpy view of its storage, which pickle protocol 5 (used by ray)
+        transfers as an out-of-band buffer without copying it into the pickled bytes.
+        """
         if self.batch is not None:
-            batch_to_save: TensorDict = self.batch.contiguous()
-            batch_to_save: TensorDict = batch_to_save.consolidate()
-        else:
-            batch_to_save = None
+            tensors = {}
+            for key, tensor in self.batch.items(include_nested=True, leaves_only=True):
+                tensor = tensor.detach().cpu().contiguous()
+                tensors[key] = (tensor.dtype, tuple(tensor.shape), tensor.view(-1).view(torch.uint8).numpy())
 
-        buffer = io.BytesIO()
-        torch.save(batch_to_save, buffer)
-        buffer_bytes = buffer.getvalue()
-        return buffer_bytes, self.non_tensor_batch, self.meta_info
+            batch_state = {"batch_size": tuple(self.batch.batch_size), "tensors": tensors}
+        else:
+            batch_state = None
+
+        return batch_state, self.non_tensor_batch, self.meta_info
+
+    def __setstate__(
+        self, data: tuple[Union[dict[str, Any], bytes, None], dict[str, NDArray], dict[str, Any]]
+    ) -> None:
+        batch_state, non_tensor_batch, meta_info = data
+        if isinstance(batch_state, bytes):  # serialized by torch.save in previous versions
+            batch = torch.load(io.BytesIO(batch_state), weights_only=False, map_location="cpu")
+        elif batch_state is not None:
+            batch = TensorDict({}, batch_size=batch_state["batch_size"])
+            for key, (dtype, shape, array) in batch_state["tensors"].items():
+                if array.size == 0:  # the copy of an empty buffer has zero strides, which cannot be viewed
+                    batch[key] = torch.empty(shape, dtype=dtype)
+                    continue
+
+                if not array.flags.writeable:  # buffers in the ray object store are read-only
+                    array = array.copy()
+
+                batch[key] = torch.from_numpy(array).view(dtype).view(shape)
+        else:
+            batch = None
 
-    def __setstate__(self, data: tuple[bytes, dict[str, NDArray], dict[str, Any]]) -> None:
-        batch_deserialized_bytes, non_tensor_batch, meta_info = data
-        batch_deserialized = io.BytesIO(batch_deserialized_bytes)
-        batch = torch.load(batch_deserialized, weights_only=False, map_location="cpu")
         self.batch = batch
         self.non_tensor_batch = non_tensor_batch
         self.meta_info = meta_info
 
-    def save_to_disk(self, filepath: str) -> None:
-        with open(filepath, "wb") as f:
-            pickle.dump(self, f)
+    def save_to_disk(self, filepath: str, as_directory: bool = False) -> None:
+        """Save the DataProto to a pickle file, or to a directory that can be memory-mapped.
+
+        The directory holds one raw file per tensor, one npy file per non-tensor array, and a json manifest
+        with the shapes, dtypes and meta info.
+        """
+        if not as_directory:
+            with open(filepath, "wb") as f:
+                pickle.dump(self, f)
+
+            return
+
+        os.makedirs(filepath, exist_ok=True)
+        manifest = {"version": DATA_PROTO_DIR_VERSION, "batch_size": None, "tensors": [], "non_tensors": []}
+        if self.batch is not None:
+            manifest["batch_size"] = list(self.batch.batch_size)
+            for i, (key, tensor) in enumerate(self.batch.items(include_nested=True, leaves_only=True)):
+                filename = f"tensor_{i}.bin"
+                tensor = tensor.detach().cpu().contiguous()
+                tensor.view(-1).view(torch.uint8).numpy().tofile(os.path.join(filepath, filename))
+                manifest["tensors"].append(
+                    {
+                        "key": key,
+                        "file": filename,
+                        "dtype": str(tensor.dtype).removeprefix("torch."),
+                        "shape": list(tensor.shape),
+                    }
+                )
+
+        for i, (key, array) in enumerate(self.non_tensor_batch.items()):
+            filename = f"non_tensor_{i}.npy"
+            np.save(os.path.join(filepath, filename), array, allow_pickle=True)
+            manifest["non_tensors"].append({"key": key, "file": filename, "dtype": str(array.dtype)})
+
+        try:
+            meta_info = json.loads(json.dumps(self.meta_info))
+        except (TypeError, ValueError):
+            meta_info = None
+
+        if meta_info is not None and meta_info == self.meta_info:
+            manifest["meta_info"] = meta_info
+        else:  # not json serializable, or the json round trip changes it (e.g., tuples)
+            with open(os.path.join(filepath, "meta_info.pkl"), "wb") as f:
+                pickle.dump(self.meta_info, f)
+
+        with open(os.path.join(filepath, DATA_PROTO_MANIFEST), "w") as f:
+            json.dump(manifest, f, indent=2)
 
     @staticmethod
-    def load_from_disk(filepath: str) -> "DataProto":
-        with open(filepath, "rb") as f:
-            data = pickle.load(f)
-            return data
+    def load_from_disk(filepath: str, mmap: bool = False) -> "DataProto":
+        """Load the DataProto saved by `save_to_disk`.
+
+        If `mmap` is True and the DataProto is saved as a directory, the tensors and numeric arrays are backed by
+        copy-on-write memory maps, so only the touched keys are read from disk.
+        """
+        if not os.path.isdir(filepath):
+            with open(filepath, "rb") as f:
+                data = pickle.load(f)
+                return data
+
+        with open(os.path.join(filepath, DATA_PROTO_MANIFEST)) as f:
+            manifest = json.load(f)
+
+        if manifest["version"] != DATA_PROTO_DIR_VERSION:
+            raise ValueError(f"Unsupported DataProto version: {manifest['version']}.")
+
+        if manifest["batch_size"] is not None:
+            batch = TensorDict({}, batch_size=manifest["batch_size"])
+            for item in manifest["tensors"]:
+                path = os.path.join(filepath, item["file"])
+                key = tuple(item["key"]) if isinstance(item["key"], list) else item["key"]
+                dtype = getattr(torch, item["dtype"])
+                if os.path.getsize(path) == 0:  # empty files cannot be mapped
+                    batch[key] = torch.empty(item["shape"], dtype=dtype)
+                    continue
+
+                if mmap:
+                    array = np.memmap(path, dtype=np.uint8, mode="c")
+                else:
+                    array = np.fromfile(path, dtype=np.uint8)
+
+                batch[key] = torch.from_numpy(array).view(dtype).view(item["shape"])
+        else:
+            batch = None
+
+        non_tensor_batch = {}
+        for item in manifest["non_tensors"]:
+            mmap_mode = "c" if mmap and item["dtype"] != "object" else None
+            path = os.path.join(filepath, item["file"])
+            non_tensor_batch[item["key"]] = np.load(path, mmap_mode=mmap_mode, allow_pickle=True)
+
+        if "meta_info" in manifest:
+            meta_info = manifest["meta_info"]
+        else:
+            with open(os.path.join(filepath, "meta_info.pkl"), "rb") as f:
+                meta_info = pickle.load(f)
+
+        return DataProto(batch=batch, non_tensor_batch=non_tensor_batch, meta_info=meta_info)
 
     def print_size(self, prefix: str = "") -> None:
         size_of_tensordict = 0
@@ -709,10 +824,10 @@ class DataProtoFuture:
 def allgather_dict_tensors(
     tensors: Union[dict[str, torch.Tensor], TensorDict], size: int, group: ProcessGroup, dim: int = 0
 ) -> Union[dict[str, torch.Tensor], TensorDict]:
-    """
-    TODO: optimize this.
-    - We can use async ops
-    - We can use only one allgather
+    """All gather a dict of tensors with one collective per dtype.
+
+    The tensors of the same dtype are flattened into one contiguous buffer, which is gathered by
+    `all_gather_into_tensor` and split back into the tensors of each rank.
     """
     if isinstance(tensors, TensorDict):
         is_tensor_dict = True
@@ -721,14 +836,24 @@ def allgather_dict_tensors(
         tensors_as_dict = tensors
         is_tensor_dict = False
 
-    output = {}
-    sorted_keys = sorted(tensors_as_dict.keys())
-    for key in sorted_keys:
+    tensors_by_dtype = defaultdict(list)
+    for key in sorted(tensors_as_dict.keys()):
         value = tensors_as_dict[key]
-        output[key] = [torch.empty_like(value) for _ in range(size)]
-        torch.distributed.all_gather(output[key], value, group=group, async_op=False)
-        output[key] = torch.cat(output[key], dim=dim)
+        tensors_by_dtype[value.dtype].append((key, value))
 
+    output = {}
+    for dtype, items in tensors_by_dtype.items():
+        local_buffer = torch.cat([value.contiguous().view(-1) for _, value in items])
+        global_buffer = torch.empty(size * local_buffer.numel(), dtype=dtype, device=local_buffer.device)
+        torch.distributed.all_gather_into_tensor(global_buffer, local_buffer, group=group, async_op=False)
+        global_buffer = global_buffer.view(size, -1)  # (size, numel)
+        offset = 0
+        for key, value in items:
+            rank_values = global_buffer[:, offset : offset + value.numel()].view(size, *value.shape)
+            output[key] = torch.cat(rank_values.unbind(0), dim=dim)
+            offset += value.numel()
+
+    output = {key: output[key] for key in tensors_as_dict.keys()}  # keep the key order
     if is_tensor_dict:
         output = TensorDict(source=output, batch_size=tensors.batch_size[0] * size)
 
@@ -739,9 +864,23 @@ def all_gather_data_proto(data: DataProto, size: int, group: ProcessGroup) -> No
     # Note that this is an inplace operator just like torch.distributed.all_gather
     prev_device = data.batch.device
     data.batch = data.batch.cuda(device=torch.cuda.current_device())
-    data.batch = allgather_dict_tensors(data.batch.contiguous(), size=size, group=group, dim=0)
-    data.batch = data.batch.to(prev_device)
-    # all gather non_tensor_batch
-    all_non_tensor_batch = [None for _ in range(size)]
-    torch.distributed.all_gather_object(all_non_tensor_batch, data.non_tensor_batch, group=group)
-    data.non_tensor_batch = {k: np.concatenate([d[k] for d in all_non_tensor_batch]) for k in data.non_tensor_batch}
+    # numeric arrays in non_tensor_batch are gathered with the tensors, only object arrays need to be pickled
+    numeric_keys = [key for key, value in data.non_tensor_batch.items() if value.dtype.kind in "biuf"]
+    object_keys = [key for key in data.non_tensor_batch.keys() if key not in numeric_keys]
+    tensors = data.batch.contiguous().to_dict()
+    for key in numeric_keys:
+        tensors[f"non_tensor_batch.{key}"] = torch.from_numpy(np.ascontiguousarray(data.non_tensor_batch[key])).to(
+            data.batch.device
+        )
+
+    tensors = allgather_dict_tensors(tensors, size=size, group=group, dim=0)
+    non_tensor_batch = {key: tensors.pop(f"non_tensor_batch.{key}").cpu().numpy() for key in numeric_keys}
+    data.batch = TensorDict(source=tensors, batch_size=data.batch.batch_size[0] * size).to(prev_device)
+    if len(object_keys) != 0:
+        all_non_tensor_batch = [None for _ in range(size)]
+        object_non_tensor_batch = {key: data.non_tensor_batch[key] for key in object_keys}
+        torch.distributed.all_gather_object(all_non_tensor_batch, object_non_tensor_batch, group=group)
+        for key in object_keys:
+            non_tensor_batch[key] = np.concatenate([d[key] for d in all_non_tensor_batch])
+
+    data.non_tensor_batch = {key: non_tensor_batch[key] for key in data.non_tensor_batch}
@@ -15,7 +15,7 @@
 from enum import Enum, auto
 from functools import wraps
 from types import FunctionType
-from typing import TYPE_CHECKING, Literal, Union
+from typing import TYPE_CHECKING, Callable, Literal, Optional, Union
 
 import ray
 
@@ -123,6 +123,29 @@ def collect_dp_compute_data_proto(worker_group: "WorkerGroup", outputs: list[Dat
     return _concat_data_proto_or_future(outputs)
 
 
+def select_keys_before_dispatch(
+    dispatch_fn: Callable, batch_keys: Optional[list[str]], non_tensor_batch_keys: Optional[list[str]]
+) -> Callable:
+    """Wrap the dispatch fn to only send the keys consumed by the worker method.
+
+    DataProto is reduced on the driver before chunking, so the unused keys do not travel to the workers.
+    """
+
+    def select(arg: Union[DataProto, object]):
+        if isinstance(arg, DataProto):
+            return arg.select(batch_keys=batch_keys, non_tensor_batch_keys=non_tensor_batch_keys)
+
+        return arg
+
+    @wraps(dispatch_fn)
+    def select_and_dispatch(worker_group: "WorkerGroup", *args, **kwargs):
+        args = tuple(select(arg) for arg in args)
+        kwargs = {key: select(value) for key, value in kwargs.items()}
+        return dispatch_fn(worker_group, *args, **kwargs)
+
+    return select_and_dispatch
+
+
 def get_predefined_dispatch_fn(dispatch_mode: Dispatch):
     predefined_dispatch_mode_fn = {
         Dispatch.ONE_TO_ALL: {
@@ -195,7 +218,19 @@ def _materialize_futures(*args, **kwargs):
     return new_args, kwargs
 
 
-def register(dispatch_mode=Dispatch.ALL_TO_ALL, execute_mode=Execute.ALL, blocking=True, materialize_futures=True):
+def register(
+    dispatch_mode=Dispatch.ALL_TO_ALL,
+    execute_mode=Execute.ALL,
+    blocking=True,
+    materialize_futures=True,
+    batch_keys: Optional[list[str]] = None,
+    non_tensor_batch_keys: Optional[list[str]] = None,
+):
+    """Register a worker method to the worker group.
+
+    `batch_keys` and `non_tensor_batch_keys` declare the keys consumed by the method, if given,
+    the DataProto arguments only carry these keys (and all meta info) when dispatched to the workers.
+    """
     _check_dispatch_mode(dispatch_mode=dispatch_mode)
     _check_execute_mode(execute_mode=execute_mode)
 
@@ -206,7 +241,13 @@ def register(dispatch_mode=Dispatch.ALL_TO_ALL, execute_mode=Execute.ALL, blocki
                 args, kwargs = _materialize_futures(*args, **kwargs)
             return func(*args, **kwargs)
 
-        attrs = {"dispatch_mode": dispatch_mode, "execute_mode": execute_mode, "blocking": blocking}
+        attrs = {
+            "dispatch_mode": dispatch_mode,
+            "execute_mode": execute_mode,
+            "blocking": blocking,
+            "batch_keys": batch_keys,
+            "non_tensor_batch_keys": non_tensor_batch_keys,
+        }
         setattr(inner, MAGIC_ATTR, attrs)
         return inner
 
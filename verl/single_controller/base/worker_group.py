@@ -21,7 +21,13 @@ import threading
 import time
 from typing import Any, Callable, Optional
 
-from .decorator import MAGIC_ATTR, Dispatch, get_predefined_dispatch_fn, get_predefined_execute_fn
+from .decorator import (
+    MAGIC_ATTR,
+    Dispatch,
+    get_predefined_dispatch_fn,
+    get_predefined_execute_fn,
+    select_keys_before_dispatch,
+)
 
 
 class ResourcePool:
@@ -166,6 +172,12 @@ class WorkerGroup:
                     dispatch_fn = dispatch_mode["dispatch_fn"]
                     collect_fn = dispatch_mode["collect_fn"]
 
+                # only send the keys consumed by the method
+                batch_keys = attribute.get("batch_keys")
+                non_tensor_batch_keys = attribute.get("non_tensor_batch_keys")
+                if batch_keys is not None or non_tensor_batch_keys is not None:
+                    dispatch_fn = select_keys_before_dispatch(dispatch_fn, batch_keys, non_tensor_batch_keys)
+
                 # get execute_fn_name
                 execute_mode = get_predefined_execute_fn(execute_mode=execute_mode)
                 wg_execute_fn_name = execute_mode["execute_fn_name"]
@@ -54,6 +54,11 @@ class DataConfig:
     max_pixels: Optional[int] = 4194304
     filter_overlong_prompts: bool = True
     filter_overlong_prompts_workers: int = 16
+    preprocess_cache_dir: Optional[str] = None
+    estimate_prompt_length: bool = False
+    image_cache_dir: Optional[str] = None
+    image_cache_max_gb: float = 16.0
+    return_multi_modal_inputs: bool = False
 
     def post_init(self):
         if self.image_dir is not None:
@@ -70,6 +75,12 @@ class DataConfig:
                 print(f"Format prompt file {self.format_prompt} not found.")
                 self.format_prompt = None
 
+        if self.preprocess_cache_dir is not None:  # ray job uses absolute path
+            self.preprocess_cache_dir = os.path.abspath(self.preprocess_cache_dir)
+
+        if self.image_cache_dir is not None:  # ray job uses absolute path
+            self.image_cache_dir = os.path.abspath(self.image_cache_dir)
+
 
 @dataclass
 class AlgorithmConfig:
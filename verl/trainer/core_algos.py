@@ -19,7 +19,6 @@ implement PPO
 """
 
 from abc import ABC, abstractmethod
-from collections import defaultdict
 from enum import Enum
 from typing import TYPE_CHECKING, Any, Literal
 
@@ -121,6 +120,46 @@ def compute_advantage_return(name: AdvantageEstimator, **kwargs) -> tuple[torch.
     return ADV_ESTIMATOR_MAP[getattr(name, "value", name)](**kwargs)
 
 
+def get_group_ids(index: Any, device: torch.device) -> tuple[torch.Tensor, torch.Tensor]:
+    """Map the group index (e.g., the uid of each prompt) to contiguous group ids, return the ids and group sizes."""
+    if isinstance(index, torch.Tensor):
+        group_ids = torch.unique(index, return_inverse=True)[1].to(device)
+    else:
+        group_ids = torch.as_tensor(np.unique(np.asarray(index), return_inverse=True)[1].reshape(-1), device=device)
+
+    return group_ids, torch.bincount(group_ids)
+
+
+def group_sum(values: torch.Tensor, group_ids: torch.Tensor, num_groups: int) -> torch.Tensor:
+    """Sum the values of each group."""
+    return torch.zeros(num_groups, dtype=values.dtype, device=values.device).scatter_add_(0, group_ids, values)
+
+
+def discounted_reverse_cumsum(values: torch.Tensor, gamma: float, chunk_size: int = 128) -> torch.Tensor:
+    """Compute `out[:, t] = sum_{k >= t} gamma ** (k - t) * values[:, k]` with chunked matmuls instead of a scan.
+
+    The sum inside each chunk and the carry between chunks are both a product with a discount matrix,
+    so the number of kernels does not grow with the sequence length.
+    """
+    gamma = float(gamma)
+    batch_size, seqlen = values.shape
+    num_chunks = (seqlen + chunk_size - 1) // chunk_size
+    chunks = F.pad(values, (0, num_chunks * chunk_size - seqlen)).view(batch_size, num_chunks, chunk_size)
+
+    def discount_matrix(size: int, factor: float) -> torch.Tensor:
+        steps = torch.arange(size, device=values.device, dtype=torch.float64)
+        exponents = steps[None, :] - steps[:, None]  # (t, k) -> k - t
+        discounts = torch.where(exponents >= 0, factor ** exponents.clamp(min=0), 0.0)
+        return discounts.to(values.dtype)
+
+    local_sums = chunks @ discount_matrix(chunk_size, gamma).T  # sum within each chunk
+    chunk_sums = local_sums[:, :, 0] @ discount_matrix(num_chunks, gamma**chunk_size).T  # sum from each chunk start
+    next_chunk_sums = F.pad(chunk_sums[:, 1:], (0, 1))
+    steps = torch.arange(chunk_size, 0, -1, device=values.device, dtype=torch.float64)
+    carry = next_chunk_sums.unsqueeze(-1) * (gamma**steps).to(values.dtype)  # gamma ** (chunk_size - t)
+    return (local_sums + carry).view(batch_size, -1)[:, :seqlen]
+
+
 @register_adv_estimator(AdvantageEstimator.GAE)
 def compute_gae_advantage_return(
     token_level_rewards: torch.Tensor,
@@ -151,16 +190,9 @@ def compute_gae_advantage_return(
             shape: (bs, response_length)
 
     """
-    lastgaelam = 0
-    advantages_reversed = []
-    gen_len = token_level_rewards.shape[-1]
-    for t in reversed(range(gen_len)):
-        nextvalues = values[:, t + 1] if t < gen_len - 1 else 0.0
-        delta = token_level_rewards[:, t] + gamma * nextvalues - values[:, t]
-        lastgaelam = delta + gamma * lam * lastgaelam
-        advantages_reversed.append(lastgaelam)
-
-    advantages = torch.stack(advantages_reversed[::-1], dim=1)
+    next_values = F.pad(values[:, 1:], (0, 1))
+    deltas = token_level_rewards + gamma * next_values - values
+    advantages = discounted_reverse_cumsum(deltas, gamma * lam)
     returns = advantages + values
     advantages = VF.masked_whiten(advantages, response_mask)
     return advantages, returns
@@ -192,21 +224,12 @@ def compute_grpo_outcome_advantage(
 
     """
     scores = token_level_rewards.sum(dim=-1)
-    id2score = defaultdict(list)
-    id2mean, id2std = {}, {}
-
-    bsz = scores.shape[0]
-    for i in range(bsz):
-        id2score[index[i]].append(scores[i])
-
-    for idx in id2score:
-        assert len(id2score[idx]) > 1, "GRPO needs rollout.n > 1."
-        id2mean[idx] = torch.mean(torch.tensor(id2score[idx]))
-        id2std[idx] = torch.std(torch.tensor(id2score[idx]))
-
-    for i in range(bsz):
-        scores[i] = (scores[i] - id2mean[index[i]]) / (id2std[index[i]] + eps)
-
+    group_ids, group_sizes = get_group_ids(index, scores.device)
+    assert (group_sizes > 1).all(), "GRPO needs rollout.n > 1."
+    group_mean = group_sum(scores, group_ids, group_sizes.numel()) / group_sizes
+    scores = scores - group_mean[group_ids]
+    group_std = torch.sqrt(group_sum(scores.square(), group_ids, group_sizes.numel()) / (group_sizes - 1))
+    scores = scores / (group_std[group_ids] + eps)
     returns = scores.unsqueeze(-1) * response_mask
     return returns, returns
 
@@ -234,22 +257,11 @@ def compute_rloo_outcome_advantage(
 
     """
     scores = token_level_rewards.sum(dim=-1)
-
-    id2score = defaultdict(list)
-    id2sum = {}
-    bsz = scores.shape[0]
-    for i in range(bsz):
-        id2score[index[i]].append(scores[i])
-
-    for idx in id2score:
-        id2sum[idx] = torch.sum(torch.tensor(id2score[idx]))
-
-    for i in range(bsz):
-        sample_num = len(id2score[index[i]])
-        assert sample_num > 1, "RLOO needs rollout.n > 1."
-        baseline = (id2sum[index[i]] - scores[i]) / (sample_num - 1)
-        scores[i] = scores[i] - baseline
-
+    group_ids, group_sizes = get_group_ids(index, scores.device)
+    assert (group_sizes > 1).all(), "RLOO needs rollout.n > 1."
+    group_scores = group_sum(scores, group_ids, group_sizes.numel())
+    baseline = (group_scores[group_ids] - scores) / (group_sizes[group_ids] - 1)
+    scores = scores - baseline
     returns = scores.unsqueeze(-1) * response_mask
     return returns, returns
 
@@ -275,14 +287,15 @@ def compute_reinforce_plus_plus_outcome_advantage(
             shape: (bs, response_length)
 
     """
-    returns = torch.zeros_like(token_level_rewards)
-    running_return = 0
-    for t in reversed(range(token_level_rewards.shape[1])):
-        running_return = token_level_rewards[:, t] + gamma * running_return
-        returns[:, t] = running_return
-        # Reset after EOS
-        running_return = running_return * response_mask[:, t]
-
+    returns = discounted_reverse_cumsum(token_level_rewards, gamma)
+    # the running return is reset after eos, so cut the sum at the next position whose mask is zero
+    seqlen = token_level_rewards.size(1)
+    positions = torch.arange(seqlen, device=token_level_rewards.device)
+    masked_positions = torch.where(response_mask.bool(), seqlen, positions)
+    next_masked = torch.cummin(masked_positions.flip(-1), dim=-1).values.flip(-1)
+    cutoff = F.pad(next_masked[:, 1:], (0, 1), value=seqlen)
+    tail_returns = F.pad(returns, (0, 1)).gather(1, cutoff)
+    returns = returns - torch.pow(gamma, (cutoff - positions).to(returns.dtype)) * tail_returns
     advantages = VF.masked_whiten(returns, response_mask)
     return advantages, returns
 
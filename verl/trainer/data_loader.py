@@ -41,6 +41,11 @@ def create_dataloader(config: DataConfig, tokenizer: PreTrainedTokenizer, proces
         max_pixels=config.max_pixels,
         filter_overlong_prompts=config.filter_overlong_prompts,
         filter_overlong_prompts_workers=config.filter_overlong_prompts_workers,
+        preprocess_cache_dir=config.preprocess_cache_dir,
+        estimate_prompt_length=config.estimate_prompt_length,
+        image_cache_dir=config.image_cache_dir,
+        image_cache_max_gb=config.image_cache_max_gb,
+        return_multi_modal_inputs=config.return_multi_modal_inputs,
     )
     # use sampler for better ckpt resume
     if config.shuffle:
@@ -79,6 +84,10 @@ def create_dataloader(config: DataConfig, tokenizer: PreTrainedTokenizer, proces
         min_pixels=config.min_pixels,
         max_pixels=config.max_pixels,
         filter_overlong_prompts=config.filter_overlong_prompts,
+        preprocess_cache_dir=config.preprocess_cache_dir,
+        estimate_prompt_length=config.estimate_prompt_length,
+        image_cache_dir=config.image_cache_dir,
+        image_cache_max_gb=config.image_cache_max_gb,
     )
 
     if config.val_batch_size == -1:
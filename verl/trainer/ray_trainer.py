@@ -30,7 +30,7 @@ import ray
 import torch
 from ray.experimental.tqdm_ray import tqdm
 from torchdata.stateful_dataloader import StatefulDataLoader
-from transformers import PreTrainedTokenizer, ProcessorMixin
+from transformers import AutoConfig, PreTrainedTokenizer, ProcessorMixin
 
 from ..protocol import DataProto, pad_dataproto_to_divisor, unpad_dataproto
 from ..single_controller.base import Worker
@@ -38,9 +38,10 @@ from ..single_controller.ray import RayClassWithInitArgs, RayResourcePool, RayWo
 from ..single_controller.ray.base import create_colocated_worker_cls
 from ..utils import torch_functional as VF
 from ..utils.checkpoint import CHECKPOINT_TRACKER, find_latest_ckpt, remove_obsolete_ckpt
+from ..utils.flops_counter import FlopsCounter
 from ..utils.logger import Tracker
 from ..utils.py_functional import convert_dict_to_str, timer, unflatten_dict
-from ..utils.seqlen_balancing import get_seqlen_balanced_partitions, log_seqlen_unbalance
+from ..utils.seqlen_balancing import get_seqlen_balanced_partitions, get_seqlen_costs, log_seqlen_unbalance
 from ..workers.fsdp_workers import FSDPWorker
 from ..workers.reward import FunctionRewardManager
 from .config import PPOConfig
@@ -181,6 +182,8 @@ class RayPPOTrainer:
         self.reward_fn = reward_fn
         self.val_reward_fn = val_reward_fn
 
+        self.pending_reward_refs: list[ray.ObjectRef] = []
+        self.pending_multi_modal_inputs: dict[str, dict[str, torch.Tensor]] = {}
         self.val_reward_score = 0.0
         self.best_val_reward_score = -1.0
         self.best_global_step = None
@@ -235,6 +238,16 @@ class RayPPOTrainer:
         ):
             raise ValueError("GRPO and RLOO algorithm need `config.worker.rollout.n > 1`.")
 
+        if config.worker.actor.balance_cost not in ("linear", "quadratic", "flops"):
+            raise NotImplementedError(f"Unknown balance cost: {config.worker.actor.balance_cost}.")
+
+        self.attention_cost_ratio = 0.0
+        if config.worker.actor.balance_cost == "flops":
+            model_config = AutoConfig.from_pretrained(
+                config.worker.actor.model.model_path, trust_remote_code=config.worker.actor.model.trust_remote_code
+            )
+            self.attention_cost_ratio = FlopsCounter(model_config).get_attention_cost_ratio()
+
         if config.trainer.max_steps is not None:
             self.training_steps = config.trainer.max_steps
         elif config.data.mini_rollout_batch_size is not None:
@@ -408,6 +421,8 @@ class RayPPOTrainer:
             test_gen_batch.meta_info["min_pixels"] = self.config.data.min_pixels
             test_gen_batch.meta_info["max_pixels"] = self.config.data.max_pixels
             test_gen_batch.meta_info["video_fps"] = self.config.data.video_fps
+            test_gen_batch.meta_info["image_cache_dir"] = self.config.data.image_cache_dir
+            test_gen_batch.meta_info["image_cache_max_gb"] = self.config.data.image_cache_max_gb
 
             test_gen_batch, pad_size = pad_dataproto_to_divisor(test_gen_batch, self.actor_rollout_ref_wg.world_size)
             test_output_gen_batch = self.actor_rollout_ref_wg.generate_sequences(test_gen_batch)
@@ -422,9 +437,9 @@ class RayPPOTrainer:
 
             # store generations
             input_ids = test_batch.batch["prompts"]
-            input_texts = [self.tokenizer.decode(ids, skip_special_tokens=True) for ids in input_ids]
+            input_texts = self.tokenizer.batch_decode(input_ids, skip_special_tokens=True)
             output_ids = test_batch.batch["responses"]
-            output_texts = [self.tokenizer.decode(ids, skip_special_tokens=True) for ids in output_ids]
+            output_texts = self.tokenizer.batch_decode(output_ids, skip_special_tokens=True)
             scores = reward_tensor.sum(-1).cpu().tolist()
             sample_inputs.extend(input_texts)
             sample_outputs.extend(output_texts)
@@ -446,14 +461,19 @@ class RayPPOTrainer:
         print("Finish validation.")
         return {"val/reward_score": self.val_reward_score, **val_reward_metrics, **val_length_metrics}
 
-    def _balance_batch(self, batch: DataProto, metrics: dict[str, Any], logging_prefix: str = "global_seqlen") -> None:
-        """Reorder the data on single controller such that each dp rank gets similar total tokens"""
+    def _balance_batch(
+        self, batch: DataProto, metrics: dict[str, Any], logging_prefix: str = "global_seqlen"
+    ) -> torch.Tensor:
+        """Reorder the data on single controller such that each dp rank gets similar compute cost"""
         attention_mask = batch.batch["attention_mask"]
         batch_size = attention_mask.shape[0]
         global_seqlen_lst = batch.batch["attention_mask"].view(batch_size, -1).sum(-1).tolist()  # (train_batch_size,)
+        global_cost_lst = get_seqlen_costs(
+            global_seqlen_lst, self.config.worker.actor.balance_cost, self.attention_cost_ratio
+        )
         world_size = self.actor_rollout_ref_wg.world_size
         global_partition_lst = get_seqlen_balanced_partitions(
-            global_seqlen_lst, k_partitions=world_size, equal_size=True
+            global_cost_lst, k_partitions=world_size, equal_size=True
         )
         # reorder based on index. The data will be automatically equally partitioned by dispatch function
         global_idx = torch.tensor([j for partition in global_partition_lst for j in partition])
@@ -462,9 +482,60 @@ class RayPPOTrainer:
             seqlen_list=global_seqlen_lst, partitions=global_partition_lst, prefix=logging_prefix
         )
         metrics.update(global_balance_stats)
+        global_cost_stats = log_seqlen_unbalance(
+            seqlen_list=global_cost_lst, partitions=global_partition_lst, prefix="global_cost"
+        )
+        metrics["global_cost/predicted_imbalance"] = global_cost_stats["global_cost/balanced_max"] / max(
+            global_cost_stats["global_cost/mean"], 1
+        )
+        return global_idx
+
+    def _generate_with_streaming_reward(
+        self, gen_batch: DataProto, ground_truth: np.ndarray
+    ) -> tuple[DataProto, list[ray.ObjectRef]]:
+        """Generate sequences and score the output of each dp rank as soon as the rank finishes.
+
+        The reward of a rank is submitted only once its output is ready, in the order the ranks finish, since the
+        reward manager is a single-threaded actor that runs its tasks in the order of submission. The vLLM rollout
+        returns the output of a rank at once, so the rewards overlap with the ranks still generating, not with the
+        generation of the same rank.
+        """
+        gen_output_future = self.actor_rollout_ref_wg.generate_sequences_async(gen_batch)
+        output_refs = gen_output_future.futures
+        ground_truth = np.repeat(ground_truth, self.config.worker.rollout.n, axis=0)
+        ground_truth_shards = np.array_split(ground_truth, len(output_refs))
+        shard_indices = {output_ref: i for i, output_ref in enumerate(output_refs)}
+        reward_refs: list[Optional[ray.ObjectRef]] = [None] * len(output_refs)
+        pending_refs = list(output_refs)
+        while len(pending_refs) != 0:
+            ready_refs, pending_refs = ray.wait(pending_refs, num_returns=1)
+            i = shard_indices[ready_refs[0]]
+            reward_refs[i] = self.reward_fn.compute_reward_shard.remote(ready_refs[0], ground_truth_shards[i])
+
+        return gen_output_future.get(), reward_refs
+
+    def _join_reward_refs(self, reward_refs: list[ray.ObjectRef]) -> tuple[torch.Tensor, dict[str, list[float]]]:
+        """Gather the rewards of the streamed shards in order."""
+        reward_tensor_lst, reward_metrics = [], defaultdict(list)
+        for reward_tensor, shard_metrics in ray.get(reward_refs):
+            reward_tensor_lst.append(reward_tensor)
+            for key, value in shard_metrics.items():
+                reward_metrics[key].extend(value)
+
+        return torch.cat(reward_tensor_lst, dim=0), reward_metrics
+
+    def _attach_multi_modal_inputs(self, batch: DataProto) -> None:
+        """Attach the processor outputs of the dataset to the batch, instead of the raw images."""
+        batch.non_tensor_batch["multi_modal_inputs"] = np.array(
+            [self.pending_multi_modal_inputs[uid] for uid in batch.non_tensor_batch["uid"]], dtype=object
+        )  # the repeated samples share the same dict, which is serialized only once
+        batch.non_tensor_batch.pop("multi_modal_data", None)
+        self.pending_multi_modal_inputs = {}
 
     def _make_batch_data(self, metrics: dict[str, Any]) -> DataProto:
         batch = None
+        self.pending_reward_refs = []
+        self.pending_multi_modal_inputs = {}
         all_metrics = defaultdict(list)
         num_try_make_batch = 0
         print("Start generating batch...")
@@ -480,21 +551,33 @@ class RayPPOTrainer:
                 "min_pixels": self.config.data.min_pixels,
                 "max_pixels": self.config.data.max_pixels,
                 "video_fps": self.config.data.video_fps,
+                "image_cache_dir": self.config.data.image_cache_dir,
+                "image_cache_max_gb": self.config.data.image_cache_max_gb,
             }
             new_batch: DataProto = DataProto.from_single_dict(batch_dict, meta_info=meta_info)
             new_batch.non_tensor_batch["uid"] = np.array(
                 [str(uuid.uuid4()) for _ in range(len(new_batch.batch))], dtype=object
             )
+            if "multi_modal_inputs" in new_batch.non_tensor_batch:
+                # keep the processor outputs aside until the workers use them, one copy per prompt
+                multi_modal_inputs = new_batch.non_tensor_batch.pop("multi_modal_inputs")
+                self.pending_multi_modal_inputs.update(zip(new_batch.non_tensor_batch["uid"], multi_modal_inputs))
 
             # pop those keys for generation
             gen_batch = new_batch.pop(
                 batch_keys=["input_ids", "attention_mask", "position_ids"],
                 non_tensor_batch_keys=["raw_prompt_ids", "multi_modal_data"],
-                meta_info_keys=["min_pixels", "max_pixels", "video_fps"],
+                meta_info_keys=["min_pixels", "max_pixels", "video_fps", "image_cache_dir", "image_cache_max_gb"],
             )
 
             # generate a batch
-            gen_batch_output = self.actor_rollout_ref_wg.generate_sequences(gen_batch)
+            reward_refs = None
+            if self.config.worker.reward.streaming:
+                gen_batch_output, reward_refs = self._generate_with_streaming_reward(
+                    gen_batch, new_batch.non_tensor_batch["ground_truth"]
+                )
+            else:
+                gen_batch_output = self.actor_rollout_ref_wg.generate_sequences(gen_batch)
 
             if self.config.algorithm.adv_estimator == "remax":
                 gen_baseline_batch = deepcopy(gen_batch)
@@ -516,7 +599,11 @@ class RayPPOTrainer:
 
             # filter group
             if self.config.algorithm.online_filtering:
-                reward_tensor, reward_metrics = ray.get(self.reward_fn.compute_reward.remote(new_batch))
+                if reward_refs is not None:
+                    reward_tensor, reward_metrics = self._join_reward_refs(reward_refs)
+                else:
+                    reward_tensor, reward_metrics = ray.get(self.reward_fn.compute_reward.remote(new_batch))
+
                 new_batch.batch["token_level_scores"] = reward_tensor
                 for k, v in reward_metrics.items():
                     all_metrics[k].extend(v)
@@ -538,6 +625,8 @@ class RayPPOTrainer:
                     raise RuntimeError("No sample is kept after filtering. Please check your data.")
 
                 new_batch = new_batch[kept_sample_idxs]
+            elif reward_refs is not None:
+                self.pending_reward_refs.extend(reward_refs)
 
             batch = DataProto.concat([batch, new_batch]) if batch is not None else new_batch
             current_batch_size = len(batch) // self.config.worker.rollout.n
@@ -596,16 +685,22 @@ class RayPPOTrainer:
                 # balance the number of valid tokens on each dp rank.
                 # NOTE: this breaks the order of data inside the batch.
                 # Please take care when you implement group based adv computation such as GRPO and rloo
-                self._balance_batch(batch, metrics=metrics)
+                balanced_idx = self._balance_batch(batch, metrics=metrics)
 
                 # compute global valid tokens
                 batch.meta_info["global_token_num"] = torch.sum(batch.batch["attention_mask"], dim=-1).tolist()
 
-                # compute reward
-                if "token_level_scores" not in batch.batch:
+                # compute reward, reuse the scores of online filtering if available
+                reuse_scores = "token_level_scores" in batch.batch
+                use_streaming_reward = not reuse_scores and len(self.pending_reward_refs) > 0
+                if not reuse_scores and not use_streaming_reward:
                     with timer("reward", timing_raw):
                         reward_ref = self.reward_fn.compute_reward.remote(batch)
 
+                # the reward function does not need the multi modal inputs, attach them after it is launched
+                if len(self.pending_multi_modal_inputs) != 0:
+                    self._attach_multi_modal_inputs(batch)
+
                 # recompute old_log_probs
                 with timer("old", timing_raw):
                     old_log_probs = self.actor_rollout_ref_wg.compute_log_probs(batch)
@@ -624,7 +719,19 @@ class RayPPOTrainer:
                         batch = batch.union(values)
 
                 with timer("adv", timing_raw):
-                    if "token_level_scores" not in batch.batch:
+                    if use_streaming_reward:
+                        # join the rewards scored during generation, and align them with the balanced batch
+                        with timer("reward", timing_raw):  # the reward time not hidden behind the other stages
+                            reward_tensor, reward_metrics = self._join_reward_refs(self.pending_reward_refs)
+
+                        batch.batch["token_level_scores"] = reward_tensor[: len(batch)][balanced_idx]
+                        # the balanced indices are within the batch, which also drops the padded samples
+                        reward_metrics = {
+                            key: [value[idx] for idx in balanced_idx.tolist()] for key, value in reward_metrics.items()
+                        }
+                        reward_metrics = {f"reward/{k}": v for k, v in reduce_metrics(reward_metrics).items()}
+                        metrics.update(reward_metrics)
+                    elif not reuse_scores:
                         # get token level scores asynchronously
                         reward_tensor, reward_metrics = ray.get(reward_ref)
                         batch.batch["token_level_scores"] = reward_tensor
@@ -662,6 +769,9 @@ class RayPPOTrainer:
 
                     actor_metrics = reduce_metrics(actor_output.non_tensor_batch)
                     metrics.update(actor_metrics)
+                    local_tflops = actor_output.non_tensor_batch["perf/local_tflops"]
+                    if np.mean(local_tflops) > 0:  # unknown models have zero flops
+                        metrics["global_cost/observed_imbalance"] = np.max(local_tflops) / np.mean(local_tflops)
 
                 # validate
                 if (
@@ -12,6 +12,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import copy
+import hashlib
+import json
 import math
 import os
 from collections import defaultdict
@@ -20,16 +23,25 @@ from typing import Any, Optional, Union
 
 import numpy as np
 import torch
-from datasets import load_dataset
+from datasets import Dataset as HFDataset
+from datasets import Features, Sequence, Value, concatenate_datasets, load_dataset
+from datasets import Image as ImageFeature
 from jinja2 import Template
-from PIL import Image
+from PIL import ExifTags, Image, ImageOps
 from PIL.Image import Image as ImageObject
 from qwen_vl_utils.vision_process import fetch_video
 from torch.utils.data import Dataset
 from transformers import PreTrainedTokenizer, ProcessorMixin
+from transformers.models.qwen2_vl.image_processing_qwen2_vl import smart_resize
 
 from ..models.transformers.qwen2_vl import get_rope_index
 from . import torch_functional as VF
+from .image_cache import ImageCache, get_image_cache
+
+
+PREPROCESS_CACHE_VERSION = 1
+PREPROCESSED_KEYS = ("input_ids", "attention_mask", "position_ids", "raw_prompt_ids")
+MULTI_MODAL_INPUT_KEYS = ("pixel_values", "image_grid_thw", "pixel_values_videos", "video_grid_thw")
 
 
 def collate_fn(features: list[dict[str, Any]]) -> dict[str, Any]:
@@ -51,25 +63,88 @@ def collate_fn(features: list[dict[str, Any]]) -> dict[str, Any]:
     return {**tensors, **non_tensors}
 
 
+def get_image_size(image: Union[dict[str, Any], ImageObject, str, bytes]) -> tuple[int, int]:
+    """Get the (width, height) of the image after `process_image` applies the EXIF orientation.
+
+    The encoded images are only opened, the size and the orientation are read from the header.
+    """
+    if isinstance(image, dict):  # the path is used only if the bytes are not embedded
+        image = image["bytes"] if image.get("bytes") is not None else image["path"]
+
+    if isinstance(image, (str, bytes)):
+        with Image.open(image if isinstance(image, str) else BytesIO(image)) as image:
+            return get_image_size(image)
+
+    width, height = image.size
+    if image.getexif().get(ExifTags.Base.Orientation) in (5, 6, 7, 8):  # transposed or rotated by 90 degrees
+        width, height = height, width
+
+    return width, height
+
+
+def disable_image_decoding(dataset: HFDataset, image_key: str) -> HFDataset:
+    """Cast the image column to `Image(decode=False)`, so that the images are returned as encoded dicts."""
+    if image_key not in dataset.column_names:
+        return dataset
+
+    feature = copy.deepcopy(dataset.features[image_key])
+    image_feature = feature[0] if isinstance(feature, list) else getattr(feature, "feature", None)
+    if not isinstance(image_feature, ImageFeature) or not image_feature.decode:
+        return dataset
+
+    image_feature.decode = False
+    return dataset.cast_column(image_key, feature)
+
+
+def get_resized_size(width: int, height: int, min_pixels: Optional[int], max_pixels: Optional[int]) -> tuple[int, int]:
+    """Get the (width, height) of the image resized by `process_image`."""
+    if max_pixels is not None and (width * height) > max_pixels:
+        resize_factor = math.sqrt(max_pixels / (width * height))
+        width, height = int(width * resize_factor), int(height * resize_factor)
+
+    if min_pixels is not None and (width * height) < min_pixels:
+        resize_factor = math.sqrt(min_pixels / (width * height))
+        width, height = int(width * resize_factor), int(height * resize_factor)
+
+    return width, height
+
+
 def process_image(
-    image: Union[dict[str, Any], ImageObject, str], min_pixels: Optional[int], max_pixels: Optional[int]
+    image: Union[dict[str, Any], ImageObject, str, bytes],
+    min_pixels: Optional[int],
+    max_pixels: Optional[int],
+    image_cache: Optional[ImageCache] = None,
 ) -> ImageObject:
+    if isinstance(image, dict):  # the path is used only if the bytes are not embedded
+        image = image["bytes"] if image.get("bytes") is not None else image["path"]
+
+    if image_cache is not None:
+        # look up the resized image by the hash of the encoded bytes, decode and resize only on misses
+        if isinstance(image, str):
+            with open(image, "rb") as f:
+                image = f.read()
+
+        key = image_cache.get_key(image, min_pixels, max_pixels)
+        cached_image = image_cache.get(key)
+        if cached_image is not None:
+            return cached_image
+
+        processed_image = process_image(image, min_pixels, max_pixels)
+        image_cache.put(key, processed_image)
+        return processed_image
+
     if isinstance(image, str):
         image = Image.open(image)
-    elif isinstance(image, dict):
-        image = Image.open(BytesIO(image["bytes"]))
     elif isinstance(image, bytes):
         image = Image.open(BytesIO(image))
 
     image.load()  # avoid "Too many open files" errors
-    if max_pixels is not None and (image.width * image.height) > max_pixels:
-        resize_factor = math.sqrt(max_pixels / (image.width * image.height))
-        width, height = int(image.width * resize_factor), int(image.height * resize_factor)
-        image = image.resize((width, height))
+    if image.getexif().get(ExifTags.Base.Orientation) is not None:
+        # apply the orientation as the decoding of datasets does, no-op for the images decoded by datasets
+        image = ImageOps.exif_transpose(image)
 
-    if min_pixels is not None and (image.width * image.height) < min_pixels:
-        resize_factor = math.sqrt(min_pixels / (image.width * image.height))
-        width, height = int(image.width * resize_factor), int(image.height * resize_factor)
+    width, height = get_resized_size(image.width, image.height, min_pixels, max_pixels)
+    if (width, height) != image.size:
         image = image.resize((width, height))
 
     if image.mode != "RGB":
@@ -108,6 +183,11 @@ class RLHFDataset(Dataset):
         max_pixels: Optional[int] = None,
         filter_overlong_prompts: bool = True,
         filter_overlong_prompts_workers: int = 16,
+        preprocess_cache_dir: Optional[str] = None,
+        estimate_prompt_length: bool = False,
+        image_cache_dir: Optional[str] = None,
+        image_cache_max_gb: float = 16.0,
+        return_multi_modal_inputs: bool = False,
     ):
         self.tokenizer = tokenizer
         self.processor = processor
@@ -121,6 +201,10 @@ class RLHFDataset(Dataset):
         self.truncation = truncation
         self.min_pixels = min_pixels
         self.max_pixels = max_pixels
+        self.estimate_prompt_length = estimate_prompt_length
+        self.image_cache = get_image_cache(image_cache_dir, image_cache_max_gb)
+        self.return_multi_modal_inputs = return_multi_modal_inputs
+        self.preprocessed = False
 
         if "@" in data_path:
             data_path, data_split = data_path.split("@")
@@ -138,18 +222,35 @@ class RLHFDataset(Dataset):
             # load remote dataset from huggingface hub
             self.dataset = load_dataset(data_path, split=data_split)
 
+        if self.image_cache is not None:
+            # keep the images encoded, so that they are decoded only on the misses of the image cache
+            self.dataset = disable_image_decoding(self.dataset, self.image_key)
+
         self.format_prompt = None
         if format_prompt:
             with open(format_prompt, encoding="utf-8") as f:
                 self.format_prompt = f.read()
 
+        if preprocess_cache_dir is not None or filter_overlong_prompts:
+            # preprocess the dataset once, the prompt lengths (and model inputs if the cache is enabled)
+            # are kept as columns, which are reused in later epochs and restarts
+            self._preprocess_dataset(preprocess_cache_dir, filter_overlong_prompts_workers)
+
         if filter_overlong_prompts:
+            max_prompt_length = self.max_prompt_length
             self.dataset = self.dataset.filter(
-                self._filter_overlong_prompts,
+                lambda prompt_lengths: [length <= max_prompt_length for length in prompt_lengths],
+                input_columns=["prompt_length"],
+                batched=True,
                 desc="Filtering overlong prompts",
-                num_proc=filter_overlong_prompts_workers,
             )
 
+    @property
+    def use_mrope(self) -> bool:
+        return (
+            self.processor is not None and "Qwen2VLImageProcessor" in self.processor.image_processor.__class__.__name__
+        )
+
     def _build_messages(self, example: dict[str, Any]) -> list[dict[str, Any]]:
         prompt_str: str = example[self.prompt_key]
         if self.format_prompt:
@@ -180,66 +281,37 @@ class RLHFDataset(Dataset):
         else:
             return [{"role": "user", "content": prompt_str}]
 
-    def _filter_overlong_prompts(self, example: dict[str, Any]) -> bool:
-        messages = self._build_messages(example)
+    def _get_multi_modal_data(self, example: dict[str, Any]) -> Optional[dict[str, Any]]:
         if self.image_key in example:
-            prompt = self.processor.apply_chat_template(messages, add_generation_prompt=True, tokenize=False)
             images = example[self.image_key]
             if self.image_dir is not None and len(images) != 0 and isinstance(images[0], str):  # image paths
                 images = [os.path.join(self.image_dir, image) for image in images]
 
-            processed_images = [] if len(images) != 0 else None  # text-only data
-            for image in images:
-                processed_images.append(process_image(image, self.min_pixels, self.max_pixels))
-
-            model_inputs = self.processor(processed_images, [prompt], add_special_tokens=False, return_tensors="pt")
-            return model_inputs["input_ids"].size(-1) <= self.max_prompt_length
+            return {"images": images}
         elif self.video_key in example:
-            prompt = self.processor.apply_chat_template(messages, add_generation_prompt=True, tokenize=False)
             videos = example[self.video_key]
             if self.image_dir is not None and len(videos) != 0 and isinstance(videos[0], str):  # video paths
                 videos = [os.path.join(self.image_dir, video) for video in videos]
 
-            processed_videos = [] if len(videos) != 0 else None  # text-only data
-            for video in videos:
-                processed_videos.append(process_video(video, self.min_pixels, self.max_pixels, self.video_fps))
-
-            model_inputs = self.processor(
-                videos=processed_videos, text=[prompt], add_special_tokens=False, return_tensors="pt"
-            )
-            return model_inputs["input_ids"].size(-1) <= self.max_prompt_length
+            return {"videos": videos}
         else:
-            input_ids = self.tokenizer.apply_chat_template(messages, add_generation_prompt=True)
-            return len(input_ids) <= self.max_prompt_length
-
-    def __len__(self):
-        return len(self.dataset)
+            return None
 
-    def __getitem__(self, index):
-        example: dict = self.dataset[index]
+    def _process_example(self, example: dict[str, Any]) -> tuple[str, dict[str, Any]]:
+        """Render the prompt and call the processor (or tokenizer) on it, returns the prompt and model inputs."""
         messages = self._build_messages(example)
-        example.pop(self.prompt_key, None)
-
+        multi_modal_data = self._get_multi_modal_data(example)
         if self.image_key in example:
             prompt = self.processor.apply_chat_template(messages, add_generation_prompt=True, tokenize=False)
-            images = example.pop(self.image_key)
-            if self.image_dir is not None and len(images) != 0 and isinstance(images[0], str):  # image paths
-                images = [os.path.join(self.image_dir, image) for image in images]
-
+            images = multi_modal_data["images"]
             processed_images = [] if len(images) != 0 else None  # text-only data
             for image in images:
-                processed_images.append(process_image(image, self.min_pixels, self.max_pixels))
+                processed_images.append(process_image(image, self.min_pixels, self.max_pixels, self.image_cache))
 
             model_inputs = self.processor(processed_images, [prompt], add_special_tokens=False, return_tensors="pt")
-            input_ids = model_inputs.pop("input_ids")[0]
-            attention_mask = model_inputs.pop("attention_mask")[0]
-            example["multi_modal_data"] = {"images": images}
         elif self.video_key in example:
             prompt = self.processor.apply_chat_template(messages, add_generation_prompt=True, tokenize=False)
-            videos = example.pop(self.video_key)
-            if self.image_dir is not None and len(videos) != 0 and isinstance(videos[0], str):  # video paths
-                videos = [os.path.join(self.image_dir, video) for video in videos]
-
+            videos = multi_modal_data["videos"]
             processed_videos = [] if len(videos) != 0 else None  # text-only data
             video_fps_list = []
             for video in videos:
@@ -254,17 +326,17 @@ class RLHFDataset(Dataset):
             )
             if "second_per_grid_ts" in self.processor.model_input_names:
                 model_inputs["second_per_grid_ts"] = [2.0 / video_sample_fps for video_sample_fps in video_fps_list]
-
-            input_ids = model_inputs.pop("input_ids")[0]
-            attention_mask = model_inputs.pop("attention_mask")[0]
-            example["multi_modal_data"] = {"videos": videos}
         else:
             prompt = self.tokenizer.apply_chat_template(messages, add_generation_prompt=True, tokenize=False)
             model_inputs = self.tokenizer([prompt], add_special_tokens=False, return_tensors="pt")
-            input_ids = model_inputs.pop("input_ids")[0]
-            attention_mask = model_inputs.pop("attention_mask")[0]
 
-        if self.processor is not None and "Qwen2VLImageProcessor" in self.processor.image_processor.__class__.__name__:
+        return prompt, model_inputs
+
+    def _build_model_inputs(self, prompt: str, model_inputs: dict[str, Any]) -> dict[str, Any]:
+        """Build the padded input ids, attention mask and position ids, and the raw prompt ids for rollout."""
+        input_ids = model_inputs["input_ids"][0]
+        attention_mask = model_inputs["attention_mask"][0]
+        if self.use_mrope:
             # qwen2vl mrope
             position_ids = get_rope_index(
                 self.processor,
@@ -295,9 +367,205 @@ class RLHFDataset(Dataset):
             elif self.truncation == "error":
                 raise RuntimeError(f"Prompt length {len(raw_prompt_ids)} is longer than {self.max_prompt_length}.")
 
-        example["input_ids"] = input_ids
-        example["attention_mask"] = attention_mask
-        example["position_ids"] = position_ids
-        example["raw_prompt_ids"] = raw_prompt_ids
+        return {
+            "input_ids": input_ids,
+            "attention_mask": attention_mask,
+            "position_ids": position_ids,
+            "raw_prompt_ids": raw_prompt_ids,
+        }
+
+    def _get_fingerprint(self, length_only: bool = False) -> str:
+        """Fingerprint of the dataset, tokenizer, processor, template and pixel settings.
+
+        The length settings are left out if `length_only` is True, as they do not change the prompt lengths.
+        """
+        processor_config = None
+        if self.processor is not None:
+            processor_config = {
+                "class": self.processor.__class__.__name__,
+                "chat_template": getattr(self.processor, "chat_template", None),
+                "image_processor": self.processor.image_processor.to_dict(),
+            }
+
+        state = {
+            "version": PREPROCESS_CACHE_VERSION,
+            "dataset": self.dataset._fingerprint,
+            "tokenizer": {
+                "class": self.tokenizer.__class__.__name__,
+                "name_or_path": self.tokenizer.name_or_path,
+                "vocab_size": len(self.tokenizer),
+                "chat_template": self.tokenizer.chat_template,
+                "pad_token_id": self.tokenizer.pad_token_id,
+            },
+            "processor": processor_config,
+            "format_prompt": self.format_prompt,
+            "keys": [self.prompt_key, self.image_key, self.video_key],
+            "image_dir": self.image_dir,
+            "video_fps": self.video_fps,
+            "min_pixels": self.min_pixels,
+            "max_pixels": self.max_pixels,
+        }
+        if not length_only:
+            state["max_prompt_length"] = self.max_prompt_length
+            state["truncation"] = self.truncation
+
+        return hashlib.sha256(json.dumps(state, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+    def _preprocess(self, example: dict[str, Any]) -> dict[str, Any]:
+        prompt, model_inputs = self._process_example(example)
+        prompt_length = model_inputs["input_ids"].size(-1)
+        if prompt_length > self.max_prompt_length and self.truncation == "error":
+            # cannot be truncated, they are either filtered or raise errors in __getitem__
+            inputs = {key: [] for key in PREPROCESSED_KEYS}
+        else:
+            inputs = self._build_model_inputs(prompt, model_inputs)
+            inputs = {
+                key: value.tolist() if isinstance(value, torch.Tensor) else value for key, value in inputs.items()
+            }
+
+        inputs["prompt_length"] = prompt_length
+        return inputs
+
+    def _estimate_prompt_length(self, example: dict[str, Any]) -> Optional[int]:
+        """Count the prompt tokens from the image sizes in the headers, without decoding and processing the images.
+
+        The image tokens follow from the image size after the resize of `process_image` and the image processor.
+        Returns None for the processors other than Qwen2-VL, then the full processing should be used.
+        """
+        image_processor = getattr(self.processor, "image_processor", None)
+        if (
+            self.image_key not in example
+            or "Qwen2VLImageProcessor" not in image_processor.__class__.__name__
+            or not image_processor.do_resize
+        ):
+            return None
+
+        messages = self._build_messages(example)
+        prompt = self.processor.apply_chat_template(messages, add_generation_prompt=True, tokenize=False)
+        images = self._get_multi_modal_data(example)["images"]
+        image_token = getattr(self.processor, "image_token", None)
+        if image_token is None or prompt.count(image_token) != len(images):
+            return None
+
+        prompt_length = len(self.tokenizer.encode(prompt, add_special_tokens=False))
+        factor = image_processor.patch_size * image_processor.merge_size
+        for image in images:
+            width, height = get_resized_size(*get_image_size(image), self.min_pixels, self.max_pixels)
+            try:
+                resized_height, resized_width = smart_resize(
+                    height,
+                    width,
+                    factor=factor,
+                    min_pixels=image_processor.size["shortest_edge"],
+                    max_pixels=image_processor.size["longest_edge"],
+                )
+            except ValueError:  # invalid image size
+                return None
+
+            if resized_height == 0 or resized_width == 0:  # rejected by the image processor
+                return None
+
+            # each image pad token is expanded to the image tokens
+            prompt_length += (resized_height // factor) * (resized_width // factor) - 1
+
+        return prompt_length
+
+    def _compute_prompt_length(self, example: dict[str, Any]) -> dict[str, int]:
+        prompt_length = self._estimate_prompt_length(example) if self.estimate_prompt_length else None
+        if prompt_length is None:
+            _, model_inputs = self._process_example(example)
+            prompt_length = model_inputs["input_ids"].size(-1)
+
+        return {"prompt_length": prompt_length}
+
+    def _preprocess_dataset(self, cache_dir: Optional[str], num_proc: int) -> None:
+        """Add the prompt length column, and the model input columns if `cache_dir` is given.
+
+        Without `cache_dir`, the lengths are cached by datasets alongside the dataset files (if any).
+        """
+        if cache_dir is not None:
+            fingerprint = f"preprocessed_{self._get_fingerprint()}"
+            function = self._preprocess
+            features = Features(
+                {
+                    "input_ids": Sequence(Value("int64")),
+                    "attention_mask": Sequence(Value("int64")),
+                    "position_ids": Sequence(Sequence(Value("int64"))) if self.use_mrope else Sequence(Value("int64")),
+                    "raw_prompt_ids": Sequence(Value("int64")),
+                    "prompt_length": Value("int64"),
+                }
+            )
+            os.makedirs(cache_dir, exist_ok=True)
+            cache_file_name = os.path.join(cache_dir, f"{fingerprint}.arrow")
+        else:
+            fingerprint = f"prompt_length_{self._get_fingerprint(length_only=True)}"
+            function = self._compute_prompt_length
+            features = Features({"prompt_length": Value("int64")})
+            cache_file_name = None
+
+        # the images are decoded in `process_image` if needed, the length estimate only reads the headers
+        dataset = disable_image_decoding(self.dataset, self.image_key)
+        preprocessed = dataset.map(
+            function,
+            remove_columns=dataset.column_names,
+            features=features,
+            num_proc=num_proc if len(dataset) > num_proc else None,
+            cache_file_name=cache_file_name,
+            new_fingerprint=fingerprint,
+            desc="Preprocessing dataset",
+        )
+        self.dataset = concatenate_datasets([self.dataset, preprocessed], axis=1)
+        self.preprocessed = cache_dir is not None
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def _process_multi_modal_inputs(self, multi_modal_data: dict[str, Any]) -> dict[str, torch.Tensor]:
+        """Run the image processor alone, for the examples whose prompts are preprocessed."""
+        if len(multi_modal_data.get("images", [])) != 0:
+            images = [
+                process_image(image, self.min_pixels, self.max_pixels, self.image_cache)
+                for image in multi_modal_data["images"]
+            ]
+            return dict(self.processor.image_processor(images=images, return_tensors="pt"))
+        elif len(multi_modal_data.get("videos", [])) != 0:
+            videos = [
+                process_video(video, self.min_pixels, self.max_pixels, self.video_fps)
+                for video in multi_modal_data["videos"]
+            ]
+            return dict(self.processor.image_processor(images=None, videos=videos, return_tensors="pt"))
+        else:
+            return {}
+
+    def __getitem__(self, index):
+        example: dict = self.dataset[index]
+        model_inputs = None
+        if self.preprocessed and len(example["input_ids"]) != 0:
+            inputs = {
+                "input_ids": torch.tensor(example.pop("input_ids")),
+                "attention_mask": torch.tensor(example.pop("attention_mask")),
+                "position_ids": torch.tensor(example.pop("position_ids")),
+                "raw_prompt_ids": example.pop("raw_prompt_ids"),
+            }
+        else:
+            prompt, model_inputs = self._process_example(example)
+            inputs = self._build_model_inputs(prompt, model_inputs)
+
+        multi_modal_data = self._get_multi_modal_data(example)
+        for key in (self.prompt_key, self.image_key, self.video_key, "prompt_length", *PREPROCESSED_KEYS):
+            example.pop(key, None)
+
+        if multi_modal_data is not None:
+            example["multi_modal_data"] = multi_modal_data
+            if self.return_multi_modal_inputs:
+                # the processor outputs are consumed by the workers, which saves re-processing the images there
+                if model_inputs is not None:
+                    multi_modal_inputs = {k: v for k, v in model_inputs.items() if k in MULTI_MODAL_INPUT_KEYS}
+                else:
+                    multi_modal_inputs = self._process_multi_modal_inputs(multi_modal_data)
+
+                example["multi_modal_inputs"] = multi_modal_inputs
+
+        example.update(inputs)
         example["ground_truth"] = example.pop(self.answer_key)
         return example
@@ -80,7 +80,7 @@ class FlopsCounter:
     def _estimate_unknown_flops(self, tokens_sum: int, batch_seqlens: List[int], delta_time: float) -> float:
         return 0
 
-    def _estimate_llama_flops(self, tokens_sum: int, batch_seqlens: List[int], delta_time: float) -> float:
+    def _get_llama_flops_coefficients(self) -> Tuple[float, float]:
         hidden_size = self.config.hidden_size
         vocab_size = self.config.vocab_size
         num_hidden_layers = self.config.num_hidden_layers
@@ -100,21 +100,32 @@ class FlopsCounter:
         emd_and_lm_head_N = vocab_size * hidden_size * 2
         # non-attn all_layer parm
         dense_N = (mlp_N + attn_linear_N) * num_hidden_layers + emd_and_lm_head_N
-        # non-attn all_layer & all_token fwd & bwd flops
-        dense_N_flops = 6 * dense_N * tokens_sum
+        # non-attn all_layer fwd & bwd flops per token, attn all_layer fwd & bwd flops per token pair
+        return 6 * dense_N, 12 * head_dim * num_attention_heads * num_hidden_layers
 
+    def _estimate_llama_flops(self, tokens_sum: int, batch_seqlens: List[int], delta_time: float) -> float:
+        dense_N_flops, attn_flops = self._get_llama_flops_coefficients()
         # attn all_layer & all_token fwd & bwd flops
         seqlen_square_sum = 0
         for seqlen in batch_seqlens:
             seqlen_square_sum += seqlen * seqlen
 
-        attn_qkv_flops = 12 * seqlen_square_sum * head_dim * num_attention_heads * num_hidden_layers
-
         # all_layer & all_token fwd & bwd flops
-        flops_all_token = dense_N_flops + attn_qkv_flops
+        flops_all_token = dense_N_flops * tokens_sum + attn_flops * seqlen_square_sum
         flops_achieved = flops_all_token * (1.0 / delta_time) / 1e12
         return flops_achieved
 
+    def get_attention_cost_ratio(self) -> float:
+        """
+        Get the flops of a token pair in attention divided by the flops of a token in dense layers,
+        used by the `flops` cost model for balancing sequences. Returns 0 for unknown models.
+        """
+        if self._estimate_flops != self._estimate_llama_flops:
+            return 0.0
+
+        dense_N_flops, attn_flops = self._get_llama_flops_coefficients()
+        return attn_flops / dense_N_flops
+
     def estimate_flops(self, batch_seqlens: List[int], delta_time: float) -> Tuple[float, float]:
         """
         Estimate the FLOPS based on the number of valid tokens in the current batch and the time taken.
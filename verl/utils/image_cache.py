@@ -0,0 +1,123 @@
+# Copyright 2024 Bytedance Ltd. and/or its affiliates
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+A node-local cache of the resized RGB images, shared by the dataset, rollout and workers.
+"""
+
+import hashlib
+import os
+from functools import lru_cache
+from typing import Optional, Union
+
+import numpy as np
+from PIL import Image
+from PIL.Image import Image as ImageObject
+
+
+class ImageCache:
+    """A content-addressed cache of resized images, stored as memory-mapped npy files in `cache_dir`.
+
+    The entries are keyed by the hash of the encoded image bytes (or the pixels of decoded images) and the resize
+    arguments, so that all processes on the node (e.g. in `/dev/shm`) can share them without coordination.
+    The files are written atomically and evicted in LRU order (by mtime, updated on each hit) once the cache grows
+    beyond `max_size_gb`.
+    """
+
+    def __init__(self, cache_dir: str, max_size_gb: float = 16.0):
+        self.cache_dir = cache_dir
+        self.max_size = int(max_size_gb * (1 << 30))
+        self._written_size = 0  # bytes written by this process since the last eviction
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def get_key(image: Union[bytes, ImageObject], min_pixels: Optional[int], max_pixels: Optional[int]) -> str:
+        hasher = hashlib.blake2b(digest_size=16)
+        if isinstance(image, ImageObject):  # already decoded (e.g. by datasets), keyed by the pixels
+            hasher.update(f"{image.mode}_{image.size}".encode())
+            hasher.update(image.tobytes())
+        else:
+            hasher.update(image)
+
+        return f"{hasher.hexdigest()}_{min_pixels}_{max_pixels}"
+
+    def _get_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.npy")
+
+    def get(self, key: str) -> Optional[ImageObject]:
+        path = self._get_path(key)
+        try:
+            image = Image.fromarray(np.load(path, mmap_mode="r"))
+            os.utime(path)  # mark as recently used
+        except (OSError, ValueError):  # missing, evicted by other processes or corrupted
+            return None
+
+        return image
+
+    def put(self, key: str, image: ImageObject) -> None:
+        array = np.asarray(image.convert("RGB"))
+        path = self._get_path(key)
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(temp_path, "wb") as f:
+                np.save(f, array)
+
+            os.replace(temp_path, path)
+        except OSError:  # the cache is best-effort, e.g. the disk is full
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+            return
+
+        # other processes write to the same directory, check the total size periodically
+        self._written_size += array.nbytes
+        if self._written_size > self.max_size // 16:
+            self.evict()
+
+    def evict(self) -> None:
+        """Remove the least recently used entries until the cache is below 90% of `max_size`."""
+        self._written_size = 0
+        entries, total_size = [], 0
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if entry.name.endswith(".npy"):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+                    total_size += stat.st_size
+
+        if total_size <= self.max_size:
+            return
+
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size * 0.9:
+                break
+
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+            total_size -= size
+
+
+@lru_cache
+def get_image_cache(cache_dir: Optional[str], max_size_gb: float = 16.0) -> Optional[ImageCache]:
+    """Get the image cache of this process, returns None if `cache_dir` is not specified."""
+    if cache_dir is None:
+        return None
+
+    return ImageCache(cache_dir, max_size_gb)
@@ -24,104 +24,62 @@ from torch import distributed as dist
 from ..protocol import DataProto
 
 
-class Set:
-    def __init__(self) -> None:
-        self.sum = 0
-        self.items = []
-
-    def add(self, idx: int, val: int):
-        self.items.append((idx, val))
-        self.sum += val
-
-    def merge(self, other):
-        for idx, val in other.items:
-            self.items.append((idx, val))
-            self.sum += val
-
-    def __lt__(self, other):
-        if self.sum != other.sum:
-            return self.sum < other.sum
-        if len(self.items) != len(other.items):
-            return len(self.items) < len(other.items)
-        return self.items < other.items
-
-
-class State:
-    def __init__(self, items: list[Tuple[int, int]], k: int) -> None:
-        self.k = k
-        # sets should always be decreasing order
-        self.sets = [Set() for _ in range(k)]
-        assert len(items) in [1, k], f"{len(items)} not in [1, {k}]"
-        for i, (idx, seqlen) in enumerate(items):
-            self.sets[i].add(idx=idx, val=seqlen)
-        self.sets = sorted(self.sets, reverse=True)
-
-    def get_partitions(self):
-        partitions = []
-        for i in range(len(self.sets)):
-            cur_partition = []
-            for idx, _ in self.sets[i].items:
-                cur_partition.append(idx)
-            partitions.append(cur_partition)
-        return partitions
-
-    def merge(self, other):
-        for i in range(self.k):
-            self.sets[i].merge(other.sets[self.k - 1 - i])
-        self.sets = sorted(self.sets, reverse=True)
-
-    @property
-    def spread(self) -> int:
-        return self.sets[0].sum - self.sets[-1].sum
-
-    def __lt__(self, other):
+def karmarkar_karp(seqlen_list: list[int], k_partitions: int, equal_size: bool):
+    # see: https://en.wikipedia.org/wiki/Largest_differencing_method
+    # each state is a list of k sets in decreasing order, where a set is a (sum, size, head, tail) tuple
+    # and its items form a linked list in `next_item`, so that merging two sets does not copy any item.
+    # the head is the first item of the set, which breaks the ties between sets with the same sum and size.
+    next_item = [-1] * len(seqlen_list)
+    empty_set = (0, 0, -1, -1)
+
+    def make_state(items: list[Tuple[int, int]]) -> list[Tuple[int, int, int, int]]:
+        sets = [(seqlen, 1, idx, idx) for seqlen, idx in items] + [empty_set] * (k_partitions - len(items))
+        return sorted(sets, reverse=True)
+
+    def merge(sets0: list[Tuple[int, int, int, int]], sets1: list[Tuple[int, int, int, int]]):
+        merged = []
+        for set0, set1 in zip(sets0, reversed(sets1)):
+            if set1[1] == 0:
+                merged.append(set0)
+            elif set0[1] == 0:
+                merged.append(set1)
+            else:
+                next_item[set0[3]] = set1[2]
+                merged.append((set0[0] + set1[0], set0[1] + set1[1], set0[2], set1[3]))
+
+        return sorted(merged, reverse=True)
+
+    def heap_entry(sets: list[Tuple[int, int, int, int]]):
         # least heap, let the state with largest spread to be popped first,
         # if the spread is the same, let the state who has the largest set
         # to be popped first.
-        if self.spread != other.spread:
-            return self.spread > other.spread
-        return self.sets[0] > other.sets[0]
-
-    def __repr__(self) -> str:
-        repr_str = "["
-        for i in range(self.k):
-            if i > 0:
-                repr_str += ","
-            repr_str += "{"
-            for j, (_, seqlen) in enumerate(self.sets[i].items):
-                if j > 0:
-                    repr_str += ","
-                repr_str += str(seqlen)
-            repr_str += "}"
-        repr_str += "]"
-        return repr_str
+        return (sets[-1][0] - sets[0][0], -sets[0][0], -sets[0][1], -sets[0][2], sets)
 
-
-def karmarkar_karp(seqlen_list: list[int], k_partitions: int, equal_size: bool):
-    # see: https://en.wikipedia.org/wiki/Largest_differencing_method
     sorted_seqlen_list = sorted([(seqlen, i) for i, seqlen in enumerate(seqlen_list)])
-    states_pq: list[State] = []
     if equal_size:
         assert len(seqlen_list) % k_partitions == 0, f"{len(seqlen_list)} % {k_partitions} != 0"
-        for offset in range(0, len(sorted_seqlen_list), k_partitions):
-            items = []
-            for i in range(k_partitions):
-                seqlen, idx = sorted_seqlen_list[offset + i]
-                items.append((idx, seqlen))
-            heapq.heappush(states_pq, State(items=items, k=k_partitions))
+        states_pq = [
+            heap_entry(make_state(sorted_seqlen_list[offset : offset + k_partitions]))
+            for offset in range(0, len(sorted_seqlen_list), k_partitions)
+        ]
     else:
-        for seqlen, idx in sorted_seqlen_list:
-            heapq.heappush(states_pq, State(items=[(idx, seqlen)], k=k_partitions))
+        states_pq = [heap_entry(make_state([item])) for item in sorted_seqlen_list]
 
+    heapq.heapify(states_pq)
     while len(states_pq) > 1:
-        state0 = heapq.heappop(states_pq)
-        state1 = heapq.heappop(states_pq)
-        # merge states
-        state0.merge(state1)
-        heapq.heappush(states_pq, state0)
-
-    final_state = states_pq[0]
-    partitions = final_state.get_partitions()
+        sets0 = heapq.heappop(states_pq)[-1]
+        sets1 = heapq.heappop(states_pq)[-1]
+        heapq.heappush(states_pq, heap_entry(merge(sets0, sets1)))
+
+    partitions = []
+    for _, _, idx, _ in states_pq[0][-1]:
+        partition = []
+        while idx != -1:
+            partition.append(idx)
+            idx = next_item[idx]
+
+        partitions.append(partition)
+
     if equal_size:
         for i, partition in enumerate(partitions):
             assert len(partition) * k_partitions == len(seqlen_list), (
@@ -233,15 +191,53 @@ def log_seqlen_unbalance(seqlen_list: list[int], partitions: list[list[int]], pr
     }
 
 
+def get_seqlen_costs(
+    seqlen_list: list[int], balance_cost: str = "linear", attention_cost_ratio: float = 0.0
+) -> list[int]:
+    """Estimate the compute cost of each sequence, which is balanced across dp ranks and micro batches.
+
+    Parameters:
+        seqlen_list (List[int]):
+            seq lengths of each items
+        balance_cost (str):
+            `linear` counts the tokens, `quadratic` counts the token pairs in attention,
+            `flops` counts the tokens plus the token pairs weighted by `attention_cost_ratio`
+        attention_cost_ratio (float):
+            flops of a token pair in attention divided by flops of a token in dense layers, see `FlopsCounter`
+
+    Returns:
+        costs (List[int]):
+            the cost of each items
+    """
+    if balance_cost == "linear":
+        return list(seqlen_list)
+    elif balance_cost == "quadratic":
+        return [seqlen * seqlen for seqlen in seqlen_list]
+    elif balance_cost == "flops":
+        return [seqlen + round(attention_cost_ratio * seqlen * seqlen) for seqlen in seqlen_list]
+    else:
+        raise NotImplementedError(f"Unknown balance cost: {balance_cost}.")
+
+
 def ceildiv(a: float, b: float) -> float:
     return -(a // -b)
 
 
 def rearrange_micro_batches(
-    batch: TensorDict, max_token_len: int, dp_group: Optional[dist.ProcessGroup] = None
+    batch: TensorDict,
+    max_token_len: int,
+    dp_group: Optional[dist.ProcessGroup] = None,
+    balance_cost: str = "linear",
+    attention_cost_ratio: float = 0.0,
 ) -> Tuple[list[TensorDict], list[list[int]]]:
     """Split the batch into a list of micro_batches, where the max_token_len is smaller than max_token_len
-    and the number of valid tokens in each micro batch is well balanced.
+    and the compute cost (see `get_seqlen_costs`) of each micro batch is well balanced.
+
+    The number of micro batches starts from ceil(total_seqlen / max_token_len) and grows by the number of micro
+    batches exceeding max_token_len, since the partitions balanced by the cost may hold more tokens than the others.
+    Compared with the balancing of the valid tokens only (`balance_cost="linear"` before the cost model), the linear
+    cost gives the same partitions unless one of them exceeds max_token_len, in which case more micro batches are
+    used instead of exceeding it. The micro batches are ordered by the cost rather than the sum of squared lengths.
     """
     # this is per local micro_bsz
     max_seq_len = batch["attention_mask"].shape[-1]
@@ -250,19 +246,42 @@ def rearrange_micro_batches(
     )
     effective_seqlen = torch.sum(batch["attention_mask"], dim=-1)
     total_seqlen = effective_seqlen.sum().item()
-    num_micro_batches = min(len(effective_seqlen), ceildiv(total_seqlen, max_token_len))
-    if dist.is_initialized():
-        num_micro_batches = torch.tensor([num_micro_batches], device="cuda")
-        dist.all_reduce(num_micro_batches, op=dist.ReduceOp.MAX, group=dp_group)
-        num_micro_batches = num_micro_batches.cpu().item()
-
     effective_seqlen = effective_seqlen.tolist()
-    assert num_micro_batches <= len(effective_seqlen)
-    micro_bsz_idx = get_seqlen_balanced_partitions(effective_seqlen, num_micro_batches, equal_size=False)
+    seqlen_costs = get_seqlen_costs(effective_seqlen, balance_cost, attention_cost_ratio)
+
+    def get_partitions(indices: list[int], num_micro_batches: int) -> list[list[int]]:
+        partitions = get_seqlen_balanced_partitions([seqlen_costs[idx] for idx in indices], num_micro_batches, False)
+        return [[indices[idx] for idx in partition] for partition in partitions]
 
-    # Use the sum of squared sequence lengths to approximate attention computation workload
+    def get_num_overflows(partitions: list[list[int]]) -> int:
+        return sum(sum(effective_seqlen[idx] for idx in partition) > max_token_len for partition in partitions)
+
+    # the local search needs no collectives, it ends with one micro batch per sequence at the latest
+    num_micro_batches = min(len(effective_seqlen), ceildiv(total_seqlen, max_token_len))
+    micro_bsz_idx = get_partitions(list(range(len(effective_seqlen))), num_micro_batches)
+    while (num_overflows := get_num_overflows(micro_bsz_idx)) > 0:
+        num_micro_batches = min(len(effective_seqlen), num_micro_batches + num_overflows)
+        micro_bsz_idx = get_partitions(list(range(len(effective_seqlen))), num_micro_batches)
+
+    if dist.is_initialized():
+        global_num_micro_batches = torch.tensor([num_micro_batches], device="cuda")
+        dist.all_reduce(global_num_micro_batches, op=dist.ReduceOp.MAX, group=dp_group)
+        global_num_micro_batches = global_num_micro_batches.cpu().item()
+        assert global_num_micro_batches <= len(effective_seqlen)
+        if global_num_micro_batches > num_micro_batches:
+            partitions = get_partitions(list(range(len(effective_seqlen))), global_num_micro_batches)
+            if get_num_overflows(partitions) == 0:
+                micro_bsz_idx = partitions
+            else:  # the balanced partitions may overflow with more micro batches, split the fitting ones instead
+                while len(micro_bsz_idx) < global_num_micro_batches:
+                    micro_bsz_idx.sort(
+                        key=lambda partition: (len(partition) > 1, sum(seqlen_costs[i] for i in partition))
+                    )
+                    micro_bsz_idx.extend(get_partitions(micro_bsz_idx.pop(), 2))
+
+    # Use the same cost model to put the heaviest micro batches first
     def compute_workload(partition: list[int]) -> Tuple[int, int]:
-        return (sum(effective_seqlen[idx] ** 2 for idx in partition), min(partition) if partition else 0)
+        return (sum(seqlen_costs[idx] for idx in partition), min(partition) if partition else 0)
 
     micro_bsz_idx.sort(key=compute_workload, reverse=True)
 
@@ -292,19 +311,28 @@ def get_reverse_idx(idx_map: list[int]) -> list[int]:
     return reverse_idx_map
 
 
-def prepare_dynamic_batch(data: DataProto, max_token_len: int) -> tuple[list[DataProto], list[list[int]]]:
+def prepare_dynamic_batch(
+    data: DataProto, max_token_len: int, balance_cost: str = "linear", attention_cost_ratio: float = 0.0
+) -> tuple[list[DataProto], list[list[int]]]:
     """
     Prepare a batch for dynamic batching.
 
     Args:
         data (DataProto): The input data.
         max_token_len (int): The maximum token length for dynamic batching.
+        balance_cost (str): The cost model for balancing the micro batches, see `get_seqlen_costs`.
+        attention_cost_ratio (float): The ratio of attention flops for the `flops` cost model.
 
     Returns:
         Tuple[List[DataProto], List[List[int]]]: A tuple containing a list of DataProto objects
         and a list of index lists.
     """
-    batch, batch_idx_list = rearrange_micro_batches(data.batch, max_token_len=max_token_len)
+    batch, batch_idx_list = rearrange_micro_batches(
+        data.batch,
+        max_token_len=max_token_len,
+        balance_cost=balance_cost,
+        attention_cost_ratio=attention_cost_ratio,
+    )
     micro_batches = []
     for i, batch_idx in enumerate(batch_idx_list):
         tensors = dict(batch[i])
@@ -98,6 +98,8 @@ class ActorConfig:
     """use padding-free training"""
     dynamic_batching: bool = True
     """enable dynamic batching"""
+    balance_cost: str = "linear"
+    """cost model for balancing dp ranks and micro batches: `linear`, `quadratic`, `flops`"""
     ulysses_size: int = 1
     """ulysses sequence parallel size"""
     use_torch_compile: bool = True
@@ -112,6 +114,7 @@ class ActorConfig:
     use_kl_loss: bool = field(default=False, init=False)
     kl_penalty: str = field(default="kl", init=False)
     kl_coef: float = field(default=0.0, init=False)
+    attention_cost_ratio: float = field(default=0.0, init=False)
 
 
 @dataclass
@@ -123,5 +126,7 @@ class RefConfig:
     micro_batch_size_per_device_for_experience: int = field(default=-1, init=False)
     padding_free: bool = field(default=False, init=False)
     dynamic_batching: bool = field(default=False, init=False)
+    balance_cost: str = field(default="linear", init=False)
+    attention_cost_ratio: float = field(default=0.0, init=False)
     ulysses_size: int = field(default=1, init=False)
     use_torch_compile: bool = field(default=True, init=False)
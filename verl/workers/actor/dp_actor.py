@@ -196,7 +196,12 @@ class DataParallelPPOActor(BasePPOActor):
         data = data.select(select_keys, non_tensor_select_keys)
         if self.config.dynamic_batching:
             max_token_len = self.config.micro_batch_size_per_device_for_experience * data.batch["input_ids"].size(-1)
-            micro_batches, batch_idx_list = prepare_dynamic_batch(data, max_token_len=max_token_len)
+            micro_batches, batch_idx_list = prepare_dynamic_batch(
+                data,
+                max_token_len=max_token_len,
+                balance_cost=self.config.balance_cost,
+                attention_cost_ratio=self.config.attention_cost_ratio,
+            )
         else:
             micro_batches = data.split(self.config.micro_batch_size_per_device_for_experience)
 
@@ -240,7 +245,12 @@ class DataParallelPPOActor(BasePPOActor):
                 if self.config.dynamic_batching:
                     max_input_len = mini_batch.batch["input_ids"].size(-1)
                     max_token_len = self.config.micro_batch_size_per_device_for_update * max_input_len
-                    micro_batches, _ = prepare_dynamic_batch(mini_batch, max_token_len=max_token_len)
+                    micro_batches, _ = prepare_dynamic_batch(
+                        mini_batch,
+                        max_token_len=max_token_len,
+                        balance_cost=self.config.balance_cost,
+                        attention_cost_ratio=self.config.attention_cost_ratio,
+                    )
                 else:
                     micro_batches = mini_batch.split(self.config.micro_batch_size_per_device_for_update)
 
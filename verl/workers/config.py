@@ -49,5 +49,7 @@ class WorkerConfig:
         self.ref.micro_batch_size_per_device_for_experience = self.actor.micro_batch_size_per_device_for_experience
         self.ref.padding_free = self.actor.padding_free
         self.ref.dynamic_batching = self.actor.dynamic_batching
+        self.ref.balance_cost = self.actor.balance_cost
+        self.critic.balance_cost = self.actor.balance_cost
         self.ref.ulysses_size = self.actor.ulysses_size
         self.ref.use_torch_compile = self.actor.use_torch_compile
@@ -49,3 +49,5 @@ class CriticConfig:
     offload: OffloadConfig = field(default_factory=OffloadConfig)
     # below are auto keys
     global_batch_size_per_device: int = field(default=-1, init=False)
+    balance_cost: str = field(default="linear", init=False)
+    attention_cost_ratio: float = field(default=0.0, init=False)
@@ -51,6 +51,7 @@ from ..utils.fsdp_utils import (
     offload_fsdp_model,
     offload_fsdp_optimizer,
 )
+from ..utils.image_cache import get_image_cache
 from ..utils.model_utils import print_gpu_memory_usage, print_model_size
 from ..utils.tokenizer import get_processor, get_tokenizer
 from ..utils.torch_dtypes import PrecisionType
@@ -61,6 +62,11 @@ from .sharding_manager import FSDPVLLMShardingManager
 from .sharding_manager.fsdp_ulysses import FSDPUlyssesShardingManager
 
 
+# the keys consumed by the workers, other keys are not sent to the workers
+MODEL_INPUT_KEYS = ["input_ids", "attention_mask", "position_ids", "responses"]
+MULTI_MODAL_KEYS = ["uid", "multi_modal_data", "multi_modal_inputs"]
+
+
 class FSDPWorker(Worker):
     def __init__(
         self,
@@ -409,6 +415,10 @@ class FSDPWorker(Worker):
 
         if self._has_actor or self._has_critic:
             self.flops_counter = FlopsCounter(self.model_config)
+            attention_cost_ratio = self.flops_counter.get_attention_cost_ratio()
+            self.config.actor.attention_cost_ratio = attention_cost_ratio
+            self.config.ref.attention_cost_ratio = attention_cost_ratio
+            self.config.critic.attention_cost_ratio = attention_cost_ratio
             self.checkpoint_manager = FSDPCheckpointManager(
                 model=self.fsdp_module,
                 optimizer=self.optimizer,
@@ -442,6 +452,9 @@ class FSDPWorker(Worker):
             offload_fsdp_optimizer(self.optimizer)
 
     def _process_multi_modal_inputs(self, data: DataProto):
+        if "multi_modal_inputs" in data.non_tensor_batch:  # processed by the dataset
+            return
+
         if "multi_modal_data" not in data.non_tensor_batch:
             return
 
@@ -452,6 +465,9 @@ class FSDPWorker(Worker):
             min_pixels = data.meta_info["min_pixels"]
             max_pixels = data.meta_info["max_pixels"]
             video_fps = data.meta_info["video_fps"]
+            image_cache = get_image_cache(
+                data.meta_info.get("image_cache_dir"), data.meta_info.get("image_cache_max_gb", 16.0)
+            )
             batch_multi_modal_inputs = []
             multi_modal_inputs_cache = {}  # avoid repeated processing for n > 1 samples
             for index, multi_modal_data in zip(
@@ -461,7 +477,7 @@ class FSDPWorker(Worker):
                     images, videos = [], []
                     if "images" in multi_modal_data:
                         for image in multi_modal_data["images"]:
-                            images.append(process_image(image, min_pixels, max_pixels))
+                            images.append(process_image(image, min_pixels, max_pixels, image_cache))
 
                     if "videos" in multi_modal_data:
                         for video in multi_modal_data["videos"]:
@@ -488,7 +504,11 @@ class FSDPWorker(Worker):
 
         data.non_tensor_batch["multi_modal_inputs"] = self._cache["multi_modal_inputs"]
 
-    @register(dispatch_mode=Dispatch.DP_COMPUTE_PROTO)
+    @register(
+        dispatch_mode=Dispatch.DP_COMPUTE_PROTO,
+        batch_keys=MODEL_INPUT_KEYS + ["response_mask", "old_log_probs", "ref_log_probs", "advantages"],
+        non_tensor_batch_keys=MULTI_MODAL_KEYS,
+    )
     def update_actor(self, data: DataProto):
         assert self._has_actor
 
@@ -512,6 +532,9 @@ class FSDPWorker(Worker):
             metrics["perf/mfu_actor"] = (
                 estimated_flops * self.config.actor.ppo_epochs / (promised_flops * self.world_size)
             )
+            # the flops of the local data, which shows the observed imbalance across dp ranks
+            local_seqlens = data.batch["attention_mask"].sum(dim=-1).tolist()
+            metrics["perf/local_tflops"] = self.flops_counter.estimate_flops(local_seqlens, 1.0)[0]
             metrics["perf/max_memory_allocated_gb"] = (
                 torch.cuda.max_memory_allocated() - self.rollout_sharding_manager.freed_bytes
             ) / (1024**3)
@@ -570,7 +593,14 @@ class FSDPWorker(Worker):
         output = output.to("cpu")
         return output
 
-    @register(dispatch_mode=Dispatch.DP_COMPUTE_PROTO)
+    @register(dispatch_mode=Dispatch.DP_COMPUTE_PROTO, blocking=False)
+    def generate_sequences_async(self, prompts: DataProto):
+        """Same as generate_sequences, but returns a DataProtoFuture holding the output of each dp rank."""
+        return self.generate_sequences(prompts)
+
+    @register(
+        dispatch_mode=Dispatch.DP_COMPUTE_PROTO, batch_keys=MODEL_INPUT_KEYS, non_tensor_batch_keys=MULTI_MODAL_KEYS
+    )
     def compute_log_probs(self, data: DataProto):
         assert self._has_actor
 
@@ -602,7 +632,9 @@ class FSDPWorker(Worker):
         output = output.to("cpu")
         return output
 
-    @register(dispatch_mode=Dispatch.DP_COMPUTE_PROTO)
+    @register(
+        dispatch_mode=Dispatch.DP_COMPUTE_PROTO, batch_keys=MODEL_INPUT_KEYS, non_tensor_batch_keys=MULTI_MODAL_KEYS
+    )
     def compute_ref_log_probs(self, data: DataProto):
         assert self._has_ref
 
@@ -630,7 +662,11 @@ class FSDPWorker(Worker):
         output = output.to("cpu")
         return output
 
-    @register(dispatch_mode=Dispatch.DP_COMPUTE_PROTO)
+    @register(
+        dispatch_mode=Dispatch.DP_COMPUTE_PROTO,
+        batch_keys=MODEL_INPUT_KEYS + ["response_mask"],
+        non_tensor_batch_keys=MULTI_MODAL_KEYS,
+    )
     def compute_values(self, data: DataProto):
         assert self._has_critic
 
@@ -652,7 +688,11 @@ class FSDPWorker(Worker):
         output = output.to("cpu")
         return output
 
-    @register(dispatch_mode=Dispatch.DP_COMPUTE_PROTO)
+    @register(
+        dispatch_mode=Dispatch.DP_COMPUTE_PROTO,
+        batch_keys=MODEL_INPUT_KEYS + ["response_mask", "values", "returns"],
+        non_tensor_batch_keys=MULTI_MODAL_KEYS,
+    )
     def update_critic(self, data: DataProto):
         assert self._has_critic
 
@@ -27,6 +27,9 @@ class RewardConfig:
     reward_function_kwargs: dict = field(default_factory=dict)
     skip_special_tokens: bool = True
     num_cpus: int = 1
+    use_process_pool: bool = False
+    cache_size: int = 0  # cache scores of repeated (response, ground truth) pairs, 0 means disabled
+    streaming: bool = False  # score the responses of each dp rank as soon as they are generated
     # below are auto keys
     reward_function_name: Optional[str] = field(default=None, init=False)
 
@@ -12,14 +12,20 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hashlib
 import importlib.util
+import json
+import multiprocessing
 import os
 import sys
 from abc import ABC, abstractmethod
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ProcessPoolExecutor
 from functools import partial
+from itertools import accumulate
 from typing import Callable, Optional, Tuple, TypedDict
 
+import numpy as np
 import torch
 from transformers import PreTrainedTokenizer
 
@@ -44,95 +50,179 @@ SequentialRewardFunction = Callable[[RewardInput], RewardScore]
 BatchRewardFunction = Callable[[list[RewardInput]], list[RewardScore]]
 
 
-class FunctionRewardManager(ABC):
-    """Reward manager for rule-based reward."""
+def load_reward_function(config: RewardConfig) -> Callable:
+    """Load the reward function from file and bind its kwargs."""
+    if config.reward_function is None:
+        raise ValueError("Reward function is not provided.")
+
+    if not os.path.exists(config.reward_function):
+        raise FileNotFoundError(f"Reward function file {config.reward_function} not found.")
+
+    spec = importlib.util.spec_from_file_location("custom_reward_fn", config.reward_function)
+    module = importlib.util.module_from_spec(spec)
+    try:
+        sys.modules["custom_reward_fn"] = module
+        spec.loader.exec_module(module)
+    except Exception as e:
+        raise RuntimeError(f"Failed to load reward function: {e}")
+
+    if not hasattr(module, config.reward_function_name):
+        raise AttributeError(f"Module {module} does not have function {config.reward_function_name}.")
+
+    reward_fn = getattr(module, config.reward_function_name)
+    return partial(reward_fn, **config.reward_function_kwargs)
 
-    def __init__(self, config: RewardConfig, tokenizer: PreTrainedTokenizer):
-        if config.reward_function is None:
-            raise ValueError("Reward function is not provided.")
 
-        if not os.path.exists(config.reward_function):
-            raise FileNotFoundError(f"Reward function file {config.reward_function} not found.")
+_worker_reward_fn: Optional[BatchRewardFunction] = None
 
-        spec = importlib.util.spec_from_file_location("custom_reward_fn", config.reward_function)
-        module = importlib.util.module_from_spec(spec)
-        try:
-            sys.modules["custom_reward_fn"] = module
-            spec.loader.exec_module(module)
-        except Exception as e:
-            raise RuntimeError(f"Failed to load reward function: {e}")
 
-        if not hasattr(module, config.reward_function_name):
-            raise AttributeError(f"Module {module} does not have function {config.reward_function_name}.")
+def _init_reward_worker(config: RewardConfig) -> None:
+    """Load the reward function once in each process of the pool."""
+    global _worker_reward_fn
+    _worker_reward_fn = load_reward_function(config)
+
+
+def _compute_scores_in_worker(reward_inputs: list[RewardInput]) -> list[RewardScore]:
+    return _worker_reward_fn(reward_inputs)
+
+
+class FunctionRewardManager(ABC):
+    """Reward manager for rule-based reward."""
 
-        reward_fn = getattr(module, config.reward_function_name)
+    def __init__(self, config: RewardConfig, tokenizer: PreTrainedTokenizer):
+        self.reward_fn = load_reward_function(config)
         print(f"Using reward function `{config.reward_function_name}` from `{config.reward_function}`.")
-        self.reward_fn = partial(reward_fn, **config.reward_function_kwargs)
         self.config = config
         self.tokenizer = tokenizer
+        self.cache: Optional[OrderedDict[bytes, RewardScore]] = OrderedDict() if config.cache_size > 0 else None
+        self.cache_salt = json.dumps(config.reward_function_kwargs, sort_keys=True, default=str).encode()
+
+    def _get_cache_key(self, reward_input: RewardInput) -> bytes:
+        """Hash the reward input together with the reward kwargs."""
+        hasher = hashlib.sha1(self.cache_salt)
+        hasher.update(f"\0{reward_input['response_length']}\0{reward_input['ground_truth']}\0".encode())
+        hasher.update(reward_input["response"].encode())
+        return hasher.digest()
+
+    def _get_reward_inputs(self, data: DataProto) -> list[RewardInput]:
+        """Decode all valid responses of the batch in a single call."""
+        responses = data.batch["responses"]
+        response_length = torch.sum(data.batch["response_mask"], dim=-1)
+        # only convert the valid tokens to python lists, the padding is often most of the tensor
+        valid_mask = torch.arange(responses.size(-1), device=responses.device) < response_length.unsqueeze(-1)
+        valid_ids = responses[valid_mask].tolist()
+        response_length = response_length.tolist()
+        offsets = [0, *accumulate(response_length)]
+        response_strs = self.tokenizer.batch_decode(
+            [valid_ids[start:end] for start, end in zip(offsets[:-1], offsets[1:])],
+            skip_special_tokens=self.config.skip_special_tokens,
+        )
+        ground_truths = data.non_tensor_batch["ground_truth"]
+        return [
+            {"response": response_str, "response_length": length, "ground_truth": ground_truth}
+            for response_str, length, ground_truth in zip(response_strs, response_length, ground_truths)
+        ]
+
+    def _get_reward_tensor(
+        self, data: DataProto, scores: list[RewardScore]
+    ) -> Tuple[torch.Tensor, dict[str, list[float]]]:
+        """Place the overall score on the last valid token of each response."""
+        reward_tensor = torch.zeros_like(data.batch["responses"], dtype=torch.float32)
+        last_token_index = (torch.sum(data.batch["response_mask"], dim=-1, keepdim=True) - 1).clamp(min=0)
+        overall_scores = torch.tensor([score["overall"] for score in scores], dtype=torch.float32).unsqueeze(-1)
+        reward_tensor.scatter_(1, last_token_index.long(), overall_scores)
+        reward_metrics = defaultdict(list)
+        for score in scores:
+            for key, value in score.items():
+                reward_metrics[key].append(value)
+
+        return reward_tensor, reward_metrics
 
     @abstractmethod
+    def _compute_scores(self, reward_inputs: list[RewardInput]) -> list[RewardScore]:
+        """Compute scores for a list of reward inputs."""
+        ...
+
+    def _compute_scores_with_cache(self, reward_inputs: list[RewardInput]) -> Tuple[list[RewardScore], list[float]]:
+        """Look up the LRU cache and only score the unique inputs that miss it."""
+        scores: list[Optional[RewardScore]] = [None] * len(reward_inputs)
+        cache_hits = [0.0] * len(reward_inputs)
+        missed_indices = defaultdict(list)
+        for i, reward_input in enumerate(reward_inputs):
+            key = self._get_cache_key(reward_input)
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                scores[i] = self.cache[key]
+                cache_hits[i] = 1.0
+            else:
+                missed_indices[key].append(i)
+
+        if len(missed_indices) > 0:
+            missed_keys = list(missed_indices.keys())
+            missed_scores = self._compute_scores([reward_inputs[missed_indices[key][0]] for key in missed_keys])
+            for key, score in zip(missed_keys, missed_scores):
+                for i in missed_indices[key]:
+                    scores[i] = score
+
+                self.cache[key] = score
+                if len(self.cache) > self.config.cache_size:
+                    self.cache.popitem(last=False)
+
+        return scores, cache_hits
+
     def compute_reward(self, data: DataProto) -> Tuple[torch.Tensor, dict[str, list[float]]]:
         """Compute reward for a batch of data."""
-        ...
+        reward_inputs = self._get_reward_inputs(data)
+        if self.cache is None:
+            return self._get_reward_tensor(data, self._compute_scores(reward_inputs))
+
+        scores, cache_hits = self._compute_scores_with_cache(reward_inputs)
+        reward_tensor, reward_metrics = self._get_reward_tensor(data, scores)
+        reward_metrics["cache_hit"] = cache_hits
+        return reward_tensor, reward_metrics
+
+    def compute_reward_shard(
+        self, data: DataProto, ground_truth: np.ndarray
+    ) -> Tuple[torch.Tensor, dict[str, list[float]]]:
+        """Compute reward for the responses of a single dp rank, used to overlap reward with generation."""
+        data.non_tensor_batch["ground_truth"] = ground_truth
+        return self.compute_reward(data)
 
 
 class SequentialFunctionRewardManager(FunctionRewardManager):
     reward_fn: SequentialRewardFunction
 
-    def compute_reward(self, data: DataProto) -> Tuple[torch.Tensor, dict[str, list[float]]]:
-        reward_tensor = torch.zeros_like(data.batch["responses"], dtype=torch.float32)
-        reward_metrics = defaultdict(list)
-        response_ids = data.batch["responses"]
-        response_length = torch.sum(data.batch["response_mask"], dim=-1)
-        for i in range(len(data)):
-            cur_response_length = int(response_length[i].item())  # avoid tensor indexing error
-            valid_response_ids = response_ids[i][:cur_response_length]
-            response_str = self.tokenizer.decode(
-                valid_response_ids, skip_special_tokens=self.config.skip_special_tokens
-            )
-            score = self.reward_fn(
-                {
-                    "response": response_str,
-                    "response_length": cur_response_length,
-                    "ground_truth": data.non_tensor_batch["ground_truth"][i],
-                }
-            )
-            reward_tensor[i, cur_response_length - 1] = score["overall"]
-            for key, value in score.items():
-                reward_metrics[key].append(value)
-
-        return reward_tensor, reward_metrics
+    def _compute_scores(self, reward_inputs: list[RewardInput]) -> list[RewardScore]:
+        return [self.reward_fn(reward_input) for reward_input in reward_inputs]
 
 
 class BatchFunctionRewardManager(FunctionRewardManager):
     reward_fn: BatchRewardFunction
 
-    def compute_reward(self, data: DataProto) -> Tuple[torch.Tensor, dict[str, list[float]]]:
-        reward_inputs = []
-        response_ids = data.batch["responses"]
-        response_length = torch.sum(data.batch["response_mask"], dim=-1)
-        for i in range(len(data)):
-            cur_response_length = int(response_length[i].item())  # avoid tensor indexing error
-            valid_response_ids = response_ids[i][:cur_response_length]
-            response_str = self.tokenizer.decode(
-                valid_response_ids, skip_special_tokens=self.config.skip_special_tokens
-            )
-            reward_inputs.append(
-                {
-                    "response": response_str,
-                    "response_length": cur_response_length,
-                    "ground_truth": data.non_tensor_batch["ground_truth"][i],
-                }
+    def __init__(self, config: RewardConfig, tokenizer: PreTrainedTokenizer):
+        super().__init__(config, tokenizer)
+        self.pool: Optional[ProcessPoolExecutor] = None
+        if config.use_process_pool and config.num_cpus > 1:
+            # use spawn since forking a ray actor process is not safe
+            self.pool = ProcessPoolExecutor(
+                max_workers=config.num_cpus,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_reward_worker,
+                initargs=(config,),
             )
-
-        scores = self.reward_fn(reward_inputs)
-        reward_tensor = torch.zeros_like(data.batch["responses"], dtype=torch.float32)
-        reward_metrics = defaultdict(list)
-        for i, score in enumerate(scores):
-            cur_response_length = int(response_length[i].item())  # avoid tensor indexing error
-            reward_tensor[i, cur_response_length - 1] = score["overall"]
-            for key, value in score.items():
-                reward_metrics[key].append(value)
-
-        return reward_tensor, reward_metrics
+            print(f"Using a process pool of {config.num_cpus} workers for the reward function.")
+
+    def _compute_scores(self, reward_inputs: list[RewardInput]) -> list[RewardScore]:
+        if self.pool is None or len(reward_inputs) <= 1:
+            return self.reward_fn(reward_inputs)
+
+        # contiguous shards of equal size, the samples of a group may be split across workers,
+        # which only matters for the caches of the reward function, not for the scores
+        num_shards = min(self.config.num_cpus, len(reward_inputs))
+        shard_size = (len(reward_inputs) + num_shards - 1) // num_shards
+        shards = [reward_inputs[i : i + shard_size] for i in range(0, len(reward_inputs), shard_size)]
+        scores = []
+        for shard_scores in self.pool.map(_compute_scores_in_worker, shards):  # results are returned in order
+            scores.extend(shard_scores)
+
+        return scores
@@ -26,6 +26,7 @@ from vllm import LLM, RequestOutput, SamplingParams
 from ...protocol import DataProto
 from ...utils import torch_functional as VF
 from ...utils.dataset import process_image, process_video
+from ...utils.image_cache import ImageCache, get_image_cache
 from ...utils.torch_dtypes import PrecisionType
 from .base import BaseRollout
 from .config import RolloutConfig
@@ -50,13 +51,17 @@ def _get_logit_bias(processor: Optional[ProcessorMixin]) -> Optional[dict[int, f
 
 
 def _process_multi_modal_data(
-    multi_modal_data: dict[str, Any], min_pixels: int, max_pixels: int, video_fps: float
+    multi_modal_data: dict[str, Any],
+    min_pixels: int,
+    max_pixels: int,
+    video_fps: float,
+    image_cache: Optional[ImageCache] = None,
 ) -> dict[str, Any]:
     # may convert image path to image object
     images, videos = [], []
     if "images" in multi_modal_data:
         for image in multi_modal_data["images"]:
-            images.append(process_image(image, min_pixels, max_pixels))
+            images.append(process_image(image, min_pixels, max_pixels, image_cache))
 
     if "videos" in multi_modal_data:
         for video in multi_modal_data["videos"]:
@@ -171,6 +176,9 @@ class vLLMRollout(BaseRollout):
             raise RuntimeError("vllm sharding manager is not work properly.")
 
         if batch_multi_modal_data is not None:
+            image_cache = get_image_cache(
+                prompts.meta_info.get("image_cache_dir"), prompts.meta_info.get("image_cache_max_gb", 16.0)
+            )
             vllm_inputs = []
             for raw_prompt_ids, multi_modal_data in zip(batch_raw_prompt_ids, batch_multi_modal_data):
                 vllm_inputs.append(
@@ -181,6 +189,7 @@ class vLLMRollout(BaseRollout):
                             prompts.meta_info["min_pixels"],
                             prompts.meta_info["max_pixels"],
                             prompts.meta_info["video_fps"],
+                            image_cache,
                         ),
                     }
                 )